@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import asyncio
+import os
+
+from PyQt5.QtGui import QIcon, QImage, QPixmap
+
+
+class ThemeAssets(object):
+    """
+    Icons and pixmaps of a theme, each loaded from disk once and shared by
+    everything that displays it. `App.change_theme` replaces the whole cache
+    """
+
+    def __init__(self, theme):
+        self.theme = theme
+        self.icons = dict()  # path -> QIcon
+        self.pixmaps = dict()  # path -> QPixmap
+
+    def path(self, name):
+        return os.path.join(self.theme["path"], name)
+
+    def icon(self, name):
+        """Get the shared `QIcon` of the theme file `name`, i.e. "x.png" """
+        return self.file_icon(self.path(name))
+
+    def pixmap(self, name):
+        return self.file_pixmap(self.path(name))
+
+    def file_icon(self, path):
+        """Get a shared `QIcon` of any file, for assets outside the theme like resources/"""
+        icon = self.icons.get(path)
+        if icon is None:
+            icon = self.icons[path] = QIcon(self.file_pixmap(path))
+        return icon
+
+    def file_pixmap(self, path):
+        pixmap = self.pixmaps.get(path)
+        if pixmap is None:
+            pixmap = self.pixmaps[path] = QPixmap(path)
+        return pixmap
+
+    async def preload(self, names):
+        """
+        Decode the theme files `names` on an executor thread, only the
+        conversion to `QPixmap` happens on the GUI thread
+        """
+        loop = asyncio.get_event_loop()
+        for name in names:
+            path = self.path(name)
+            if path in self.pixmaps:
+                continue
+            image = await loop.run_in_executor(None, QImage, path)
+            if not image.isNull() and path not in self.pixmaps:
+                self.pixmaps[path] = QPixmap.fromImage(image)
@@ -23,31 +23,31 @@ import base64
 import json
 import os
 
+from config import ConfigFile, cfgdir
+
 default_auth = (None, False)
 
-authpath = "cfg/auth"
-
-if not os.path.exists("cfg"):
-    os.mkdir("cfg")
-if not os.path.exists(authpath):
-    with open(authpath, 'wb+') as af:
-        af.write(base64.b64encode(json.dumps(default_auth).encode()))
-    UserAuth = default_auth
-else:
-    with open(authpath, 'r') as af:
-        tx = af.read()
-        try:
-            UserAuth = json.loads(base64.b64decode(tx).decode())
-        except (UnicodeDecodeError, json.decoder.JSONDecodeError):
-            UserAuth = (None, False)
-
-if len(UserAuth) < len(default_auth):
-    UserAuth = default_auth
-
-if len(UserAuth) > len(default_auth):
-    UserAuth = UserAuth[len(UserAuth) - len(default_auth):]
-
-def save_auth(auth):
-    with open(authpath, 'wb+') as af:
-        jd = base64.b64encode(json.dumps(auth).encode())
-        af.write(jd)
+authpath = os.path.join(cfgdir, "auth")
+
+
+class AuthStore(ConfigFile):
+    """The saved (token, bot account) pair, base64 encoded on disk"""
+
+    def __init__(self, path=authpath):
+        super(__class__, self).__init__(path, list(default_auth))
+
+    def loads(self, text):
+        return json.loads(base64.b64decode(text).decode())
+
+    def dumps(self, data):
+        return base64.b64encode(json.dumps(data).encode()).decode()
+
+    def validate(self, data):
+        if not isinstance(data, list) or len(data) < len(default_auth):
+            return list(default_auth)
+        return data[len(data) - len(default_auth):]
+
+    def set(self, token, bot):
+        """Save a new token, written immediately since it changes so rarely"""
+        self.data = [token, bot]
+        self.save()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+class BandwidthMeter(object):
+    """
+    Counts the bytes received from the gateway (before decompression) and
+    downloaded emojis, and reports them once a minute so low bandwidth mode
+    can be checked on metered connections
+    """
+
+    def __init__(self, loop, interval=60):
+        self.loop = loop
+        self.interval = interval
+        self.total = 0
+        self.current = 0  # bytes received this interval
+        self.last = 0  # bytes received in the last full interval
+        self.loop.call_later(self.interval, self.report)
+
+    def add(self, nbytes):
+        self.total += nbytes
+        self.current += nbytes
+
+    @property
+    def per_minute(self):
+        return self.last * 60 / self.interval
+
+    def report(self):
+        self.last, self.current = self.current, 0
+        if self.last:
+            print("Received {:.1f} KiB/min ({:.1f} KiB total)".format(self.per_minute / 1024, self.total / 1024))
+        self.loop.call_later(self.interval, self.report)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""
+Offline benchmarks for message formatting, mentions, emojis and quirks.
+Runs headless with fake discord objects and synthetic messages, prints
+throughput for each case and exits non-zero if any case scales worse than
+linearly with the size of its input. --memory also compares the memory
+retained per message by a `discord.Message` and a `MessageRecord`, this
+needs discord.py
+
+    python benchmark.py [--quick] [--limit 1.3] [--memory]
+"""
+
+from contextlib import redirect_stdout
+from datetime import datetime
+from copy import deepcopy
+import argparse
+import asyncio
+import inspect
+import tracemalloc
+import timeit
+import math
+import sys
+import io
+
+from formatting import fmt_disp_msg, fmt_me_msg, fmt_markdown, color_to_span, getInitials, FormatContext
+from options import default_options
+from mentions import Mentions
+from emojis import Emojis
+from quirks import Quirks
+import pyquirks
+
+
+class FakeColor(object):
+    def __init__(self, r, g, b):
+        self.r, self.g, self.b = r, g, b
+
+    def red(self):
+        return self.r
+
+    def green(self):
+        return self.g
+
+    def blue(self):
+        return self.b
+
+    def __str__(self):
+        return "#{:02x}{:02x}{:02x}".format(self.r, self.g, self.b)
+
+
+class FakePalette(object):
+    def color(self, role):
+        return FakeColor(255, 255, 255)
+
+
+class FakeGui(object):
+    def palette(self):
+        return FakePalette()
+
+
+class FakeUser(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.color = FakeColor(id % 256, id * 7 % 256, id * 13 % 256)
+        self.mention = "<@{}>".format(id)
+
+
+class FakeChannel(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.mention = "<#{}>".format(id)
+
+
+class FakeMessage(object):
+    def __init__(self, content, author, mentions=(), channel_mentions=(), role_mentions=()):
+        self.content = content
+        self.author = author
+        self.created_at = datetime.utcnow()
+        self.mentions = mentions
+        self.channel_mentions = channel_mentions
+        self.role_mentions = role_mentions
+
+
+class FakeApp(object):
+    """Just enough of `App` for the formatting functions"""
+
+    def __init__(self):
+        self.options = deepcopy(default_options)
+        self.gui = FakeGui()
+        self.emojis = Emojis(self)
+        self.mentions = Mentions
+        self.formatter = FormatContext(self)
+        self.nick = "benchmarkBot"
+
+    @staticmethod
+    def getColor(member, type=str):
+        clr = member.color
+        return "rgb({clr.r},{clr.g},{clr.b})".format(clr=clr)
+
+    def get_emoji(self, id):
+        return None
+
+
+def make_quirks(count):
+    """A `Quirks` holding `count` quirks, without touching cfg/quirks.json"""
+    quirks = Quirks.__new__(Quirks)
+    kinds = [("prefix", "~"), ("suffix", "~"), ("replace", ("o", "0")),
+             ("regex", (r"(\w+)ing\b", r"\1in")), ("random", (r"!", ["!!", "!?"]))]
+    quirks.quirks = [kinds[i % len(kinds)] for i in range(count)]
+    quirks.qfuncs = dict(inspect.getmembers(pyquirks.quirk_funcs, inspect.isfunction))
+    return quirks
+
+
+app = FakeApp()
+author = FakeUser(1, "ghostDunk")
+others = [FakeUser(i, "carcinoGeneticist{}".format(i)) for i in range(2, 4098)]
+words = "the quick brown fox jumps over the lazy dog and keeps on running ".split()
+
+
+def text(n):
+    return " ".join(words[i % len(words)] for i in range(n))
+
+
+# name -> (make input of size n, run it)
+cases = {
+    "fmt_disp_msg plain": (
+        lambda n: FakeMessage(text(n), author),
+        lambda m: fmt_disp_msg(app, m.content, m, user=m.author)),
+    "fmt_disp_msg spoilers": (
+        lambda n: FakeMessage(" ".join("||secret {}||".format(i) for i in range(n)), author),
+        lambda m: fmt_disp_msg(app, m.content, m, user=m.author)),
+    "fmt_markdown stars": (
+        lambda n: " ".join("*a* **b** ```c```" for i in range(n)),
+        fmt_markdown),
+    "color_to_span": (
+        lambda n: "".join("<c=#ff{:04x}>word</c> ".format(i) for i in range(n)),
+        color_to_span),
+    "fmt_me_msg": (
+        lambda n: "/me's " + text(n),
+        lambda m: fmt_me_msg(app, m, author, time=True)),
+    "getInitials": (
+        lambda n: FakeUser(n, "a" * n + "B"),
+        lambda user: getInitials(app, user, c=True)),
+    "process_mentions": (
+        lambda n: FakeMessage(" ".join(u.mention for u in others[:n]), author, mentions=others[:n]),
+        lambda m: Mentions.process_mentions(m.content, m)),
+    "process_emojis": (
+        lambda n: " ".join(":grinning face: :nope: word" for i in range(n)),
+        lambda m: app.emojis.process_emojis(m, None)),
+    "process_quirks long message": (
+        lambda n: (make_quirks(10), text(n)),
+        lambda args: args[0].process_quirks(args[1])),
+    "process_quirks many quirks": (
+        lambda n: (make_quirks(n), text(50)),
+        lambda args: args[0].process_quirks(args[1])),
+}
+
+
+def measure(make, run, n, repeat):
+    value = make(n)
+    number = max(1, int(0.02 / max(timeit.timeit(lambda: run(value), number=1), 1e-7)))
+    return min(timeit.repeat(lambda: run(value), number=number, repeat=repeat)) / number
+
+
+def exponent(sizes, times):
+    """Least squares slope of log(time) over log(size), about 1 for linear work"""
+    xs = [math.log(n) for n in sizes]
+    ys = [math.log(t) for t in times]
+    mx, my = sum(xs) / len(xs), sum(ys) / len(ys)
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sum((x - mx) ** 2 for x in xs)
+
+
+class FakeClientUser(object):
+    def mentioned_in(self, message):
+        return False
+
+
+def retained(make, count):
+    """Bytes allocated per item by `make(i)` for `count` items, all kept alive"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    items = [make(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(items), items
+
+
+def message_memory(count=10000):
+    """Memory per retained message, as discord.py keeps it and as a `MessageRecord`"""
+    import discord
+    from discord.state import ConnectionState
+    from replay import BOT, DM, message_payload
+    from records import RecordTables
+
+    loop = asyncio.new_event_loop()
+    state = ConnectionState(dispatch=lambda *args: None, handlers=dict(), hooks=dict(),
+                            syncer=None, http=None, loop=loop)
+    channel = discord.DMChannel(me=state.store_user(BOT), state=state, data=DM)
+    # Payloads are made first, their content strings are shared by both
+    payloads = [message_payload(DM["id"], BOT, text(12)) for i in range(count)]
+    message_size, messages = retained(lambda i: discord.Message(state=state, channel=channel, data=payloads[i]),
+                                      count)
+
+    app.client = type("FakeClient", (), dict(user=FakeClientUser()))()
+    tables = RecordTables(app)
+    record_size, records = retained(lambda i: tables.record(messages[i]), count)
+    loop.close()
+
+    print("{:<30}{:>14}".format("retained message", "bytes"))
+    print("{:<30}{:>14.0f}".format("discord.Message", message_size))
+    print("{:<30}{:>14.0f}".format("MessageRecord", record_size))
+    print("{:.1f}x smaller".format(message_size / record_size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Formatting and quirks benchmarks")
+    parser.add_argument("--quick", action="store_true", help="smaller inputs and fewer repeats")
+    parser.add_argument("--limit", type=float, default=1.3, help="largest scaling exponent allowed")
+    parser.add_argument("--memory", action="store_true", help="compare memory per retained message")
+    args = parser.parse_args()
+    sizes = [64, 128, 256, 512] if args.quick else [128, 256, 512, 1024, 2048]
+    repeat = 3 if args.quick else 5
+
+    failed = list()
+    print("{:<30}{:>14}{:>12}".format("case", "calls/s @ max", "exponent"))
+    for name, (make, run) in cases.items():
+        # The spoiler parser prints as it works, keep that out of the report
+        with redirect_stdout(io.StringIO()):
+            times = [measure(make, run, n, repeat) for n in sizes]
+        k = exponent(sizes, times)
+        print("{:<30}{:>14.0f}{:>12.2f}{}".format(name, 1 / times[-1], k, "  FAIL" if k > args.limit else ""))
+        if k > args.limit:
+            failed.append(name)
+
+    if args.memory:
+        print()
+        message_memory()
+
+    if failed:
+        print("Super-linear scaling in: {}".format(", ".join(failed)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
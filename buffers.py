@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from collections import deque
+
+import discord
+
+from records import MENTIONS_ME
+
+
+class ChannelBuffer(object):
+    """
+    The most recent `MessageRecord`s of one channel, oldest first, and its unread
+    and mention counters. `contiguous` is False when messages newer than
+    the oldest buffered one may be missing, after a reconnect
+    """
+
+    def __init__(self, size, guild_id=None):
+        self.messages = deque(maxlen=size)
+        self.guild_id = guild_id
+        self.contiguous = True
+        self.unread = 0
+        self.mentions = 0
+
+
+class ChannelBuffers(object):
+    """
+    Ring buffers of compact message records for every channel the client
+    sees messages in, open or not. Opening a channel draws its history from
+    here, and only fetches what the buffer doesn't cover
+    """
+
+    def __init__(self, app, size):
+        self.app = app
+        self.records = app.records
+        self.size = size
+        self.buffers = dict()  # channel id -> ChannelBuffer
+
+    def get(self, channel_id, guild_id=None):
+        buffer = self.buffers.get(channel_id)
+        if buffer is None:
+            buffer = self.buffers[channel_id] = ChannelBuffer(self.size, guild_id)
+        return buffer
+
+    def resize(self, size):
+        """Change the size of every buffer, keeping the newest messages"""
+        self.size = size
+        for buffer in self.buffers.values():
+            buffer.messages = deque(buffer.messages, maxlen=size)
+
+    def append(self, message, unread=False):
+        """Buffer a received message, counting it as unread if the channel isn't being viewed"""
+        guild = message.guild
+        buffer = self.get(message.channel.id, guild.id if guild is not None else None)
+        record = self.records.record(message)
+        buffer.messages.append(record)
+        if unread:
+            buffer.unread += 1
+            if record.flags & MENTIONS_ME:
+                buffer.mentions += 1
+            self.app.on_unread(message.channel)
+
+    def replace(self, message):
+        """Swap in the edited copy of a buffered message"""
+        buffer = self.buffers.get(message.channel.id)
+        if buffer is None:
+            return
+        for idx, old in enumerate(buffer.messages):
+            if old.id == message.id:
+                buffer.messages[idx] = self.records.record(message)
+                return
+
+    def remove(self, channel_id, message_id):
+        buffer = self.buffers.get(channel_id)
+        if buffer is None:
+            return
+        for old in buffer.messages:
+            if old.id == message_id:
+                buffer.messages.remove(old)
+                return
+
+    def mark_read(self, channel):
+        buffer = self.buffers.get(channel.id)
+        if buffer is not None and (buffer.unread or buffer.mentions):
+            buffer.unread = buffer.mentions = 0
+            self.app.on_unread(channel)
+
+    def counts(self, channel_id):
+        """(unread, mentions) of a channel"""
+        buffer = self.buffers.get(channel_id)
+        if buffer is None:
+            return 0, 0
+        return buffer.unread, buffer.mentions
+
+    def guild_counts(self, guild):
+        """(unread, mentions) summed over the buffered channels of a guild"""
+        unread = mentions = 0
+        for buffer in self.buffers.values():
+            if buffer.guild_id == guild.id:
+                unread += buffer.unread
+                mentions += buffer.mentions
+        return unread, mentions
+
+    def mark_gaps(self):
+        """Called after a new gateway session, messages sent while disconnected were never received"""
+        for buffer in self.buffers.values():
+            buffer.contiguous = False
+
+    def drop(self, channel_id):
+        self.buffers.pop(channel_id, None)
+        self.records.forget_channel(channel_id)
+
+    def drop_guild(self, guild):
+        for channel_id, buffer in list(self.buffers.items()):
+            if buffer.guild_id == guild.id:
+                self.drop(channel_id)
+
+    async def history(self, channel, limit):
+        """
+        The last `limit` messages of `channel` as `MessageView`s, oldest first.
+        Only messages older than the buffer reaches are fetched, or the whole
+        history when the buffer has a gap. Fetched messages are kept in the
+        buffer as far as its size allows
+        """
+        guild = getattr(channel, "guild", None)
+        buffer = self.get(channel.id, guild.id if guild is not None else None)
+        if buffer.contiguous and len(buffer.messages) >= limit:
+            self.app.metrics.inc("history.buffered")
+            return self.views(list(buffer.messages)[-limit:])
+
+        if buffer.contiguous and buffer.messages:
+            oldest = buffer.messages[0]
+            fetched = await self.fetch(channel, limit - len(buffer.messages), before=discord.Object(oldest.id))
+            buffered = list(buffer.messages)
+            if not buffered or buffered[0] is not oldest:
+                # The buffer rolled over while fetching, the fetched messages no longer join up
+                return self.views(buffered[-limit:])
+            room = buffer.messages.maxlen - len(buffered)
+            if room > 0:
+                buffer.messages.extendleft(reversed(fetched[-room:]))
+            return self.views((fetched + buffered)[-limit:])
+
+        fetched = await self.fetch(channel, limit)
+        newest = fetched[-1].id if fetched else 0
+        received = [record for record in buffer.messages if record.id > newest]
+        buffer.messages = deque(fetched + received, maxlen=self.size)
+        buffer.contiguous = True
+        return self.views((fetched + received)[-limit:])
+
+    async def fetch(self, channel, limit, before=None):
+        """Fetch history as records, oldest first"""
+        with self.app.metrics.time("history.fetch"):
+            fetched = await self.app.run_client(channel.history(limit=limit, before=before).flatten())
+        return [self.records.record(message) for message in reversed(fetched)]
+
+    def views(self, records):
+        return [self.records.view(record) for record in records]
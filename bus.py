@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from collections import deque
+from inspect import isawaitable
+import traceback
+import threading
+import asyncio
+
+
+class ClientThread(threading.Thread):
+    """
+    Runs the Discord client's asyncio loop on its own thread, so heartbeats
+    and gateway events never wait on Qt layout, painting or modal dialogs
+    """
+
+    def __init__(self):
+        super(__class__, self).__init__(name="DiscordClient", daemon=True)
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run_sync(self, func, *args):
+        """Call `func` on the client's thread and wait for its result, for building objects bound to its loop"""
+        async def call():
+            return func(*args)
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class EventBus(object):
+    """
+    Carries calls from the client's thread to the GUI thread. Calls queue up
+    and are delivered in order, in batches: the GUI loop is woken once for
+    everything that arrived since its last delivery
+    """
+
+    def __init__(self, loop, metrics=None):
+        self.loop = loop
+        self.metrics = metrics
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.scheduled = False
+
+    def post(self, func, *args):
+        with self.lock:
+            self.queue.append((func, args))
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.loop.call_soon_threadsafe(self.deliver)
+
+    def deliver(self):
+        with self.lock:
+            batch, self.queue = self.queue, deque()
+            self.scheduled = False
+        if self.metrics is not None:
+            self.metrics.inc("bus.batches")
+            self.metrics.inc("bus.events", len(batch))
+        for func, args in batch:
+            try:
+                result = func(*args)
+                if isawaitable(result):
+                    asyncio.ensure_future(result, loop=self.loop)
+            except Exception:
+                traceback.print_exc()
@@ -19,13 +19,21 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import time
+
 import discord
 
 
-class DiscordClient(discord.Client):
-    def __init__(self, app=None, **kwargs):
-        super(self.__class__, self).__init__(**kwargs)        
-        self.app = app
+class ClientEvents(object):
+    """
+    Event handlers shared by `DiscordClient` and `AutoShardClient`. The
+    client runs on its own thread, every call into the app goes through
+    the app's `EventBus` to the GUI thread. Member lists are copied here
+    before posting, the GUI thread never iterates the client's caches
+    """
+
+    def post(self, func, *args):
+        self.app.bus.post(func, *args)
 
     async def on_ready(self):
         # Login info
@@ -33,27 +41,73 @@ class DiscordClient(discord.Client):
         print(self.user.name)
         print(self.user.id)
         print('------')
-        await self.app.on_ready()
+        self.post(self.app.members.rebuild, [member for guild in self.guilds for member in guild.members])
+        self.post(self.app.on_ready)
 
-    # async def on_socket_response(self, msg):
-    #     print(msg)
+    async def on_socket_response(self, msg):
+        if self.app.recorder is not None:
+            self.app.recorder.record(msg)
+
+    async def on_socket_raw_receive(self, msg):
+        self.received = time.perf_counter()
+        self.post(self.app.on_gateway_frame, len(msg) if isinstance(msg, bytes) else len(msg.encode()))
 
     async def on_message(self, message):
-        await self.app.on_message(message)
+        # The message arrived in the last frame received, near enough
+        started = time.perf_counter()
+        self.post(self.app.metrics.observe, "gateway.dispatch", started - getattr(self, "received", started))
+        self.post(self.app.receive_message, message, started)
+
+    async def on_message_edit(self, before, after):
+        self.post(self.app.on_message_edit, before, after)
+
+    async def on_raw_message_delete(self, payload):
+        self.post(self.app.on_raw_message_delete, payload)
+
+    async def on_guild_join(self, guild):
+        self.post(self.app.members.add_guild, guild, list(guild.members))
+
+    async def on_guild_available(self, guild):
+        self.post(self.app.members.add_guild, guild, list(guild.members))
+
+    async def on_guild_remove(self, guild):
+        self.post(self.app.on_guild_remove, guild)
+
+    async def on_member_join(self, member):
+        self.post(self.app.on_member_join, member)
+
+    async def on_member_remove(self, member):
+        self.post(self.app.on_member_remove, member)
+
+    async def on_member_update(self, before, after):
+        self.post(self.app.on_member_update, before, after)
+
+    async def on_user_update(self, before, after):
+        self.post(self.app.on_user_update, before, after)
+
+    async def on_private_channel_create(self, channel):
+        self.post(self.app.on_private_channel_create, channel)
 
+    async def on_private_channel_delete(self, channel):
+        self.post(self.app.on_private_channel_delete, channel)
 
-class AutoShardClient(discord.AutoShardedClient):
+    async def on_private_channel_update(self, before, after):
+        self.post(self.app.on_private_channel_update, after)
+
+    async def on_group_join(self, channel, user):
+        self.post(self.app.on_private_channel_update, channel)
+
+    async def on_group_remove(self, channel, user):
+        self.post(self.app.on_private_channel_update, channel)
+
+
+class DiscordClient(ClientEvents, discord.Client):
     def __init__(self, app=None, **kwargs):
         super(self.__class__, self).__init__(**kwargs)
         self.app = app
 
-    async def on_ready(self):
-        # Login info
-        print('Logged in as')
-        print(self.user.name)
-        print(self.user.id)
-        print('------')
-        await self.app.on_ready()
 
-    async def on_message(self, message):
-        await self.app.on_message(message)
+class AutoShardClient(ClientEvents, discord.AutoShardedClient):
+    def __init__(self, app=None, **kwargs):
+        super(self.__class__, self).__init__(**kwargs)
+        self.app = app
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from multiprocessing.connection import Listener, Client
+import multiprocessing
+import threading
+import asyncio
+import math
+import os
+
+from discord.http import HTTPClient
+import discord
+
+# Gateway events the GUI displays, everything else stays in the workers
+FORWARDED = frozenset(("MESSAGE_CREATE", "MESSAGE_UPDATE", "MESSAGE_DELETE", "MESSAGE_DELETE_BULK"))
+
+
+def shard_ranges(shard_count, workers):
+    """Split shard ids 0..shard_count - 1 into `workers` contiguous ranges of near equal size"""
+    workers = max(1, min(workers, shard_count))
+    size, extra = divmod(shard_count, workers)
+    ranges = list()
+    start = 0
+    for worker in range(workers):
+        end = start + size + (worker < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+def shard_for(guild_id, shard_count):
+    """The shard Discord routes a guild's events to"""
+    return (guild_id >> 22) % shard_count
+
+
+async def recommended_shards(token):
+    """Ask Discord how many shards a bot token should use, raises `discord.LoginFailure` on a bad token"""
+    http = HTTPClient()
+    try:
+        await http.static_login(token, bot=True)
+        shards, _url = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shards
+
+
+class WorkerClient(discord.AutoShardedClient):
+    """
+    The client of a cluster worker process. It only runs its range of shards
+    and forwards the raw payloads of FORWARDED events, plus per-shard stats,
+    to the GUI process
+    """
+    stats_interval = 5
+
+    def __init__(self, conn, **kwargs):
+        super(__class__, self).__init__(**kwargs)
+        self.conn = conn
+        self.events = dict.fromkeys(self.shard_ids, 0)
+        self.loop.create_task(self.report())
+
+    def forward(self, event):
+        try:
+            self.conn.send(event)
+        except OSError:
+            # The GUI process is gone
+            self.loop.create_task(self.close())
+
+    async def on_socket_response(self, msg):
+        data = msg.get("d")
+        guild_id = data.get("guild_id") if isinstance(data, dict) else None
+        if guild_id is not None:
+            shard = shard_for(int(guild_id), self.shard_count)
+        else:
+            shard = self.shard_ids[0]
+        self.events[shard] = self.events.get(shard, 0) + 1
+        if msg.get("t") in FORWARDED:
+            self.forward({"t": msg["t"], "shard": shard, "d": data})
+
+    async def report(self):
+        while not self.is_closed():
+            await asyncio.sleep(self.stats_interval)
+            latencies = dict(self.latencies)
+            events, self.events = self.events, dict.fromkeys(self.shard_ids, 0)
+            stats = dict()
+            for shard, count in events.items():
+                latency = latencies.get(shard)
+                if latency is not None and not math.isfinite(latency):
+                    latency = None  # No heartbeat acknowledged yet
+                stats[shard] = (latency, count / self.stats_interval)
+            self.forward({"t": "CLUSTER_STATS", "pid": os.getpid(), "d": stats})
+
+
+def run_worker(token, shard_ids, shard_count, address, authkey):
+    """Entry point of a cluster worker process"""
+    conn = Client(address, authkey=authkey)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # Workers keep as little state as possible, the GUI process caches what it displays.
+    # They only subscribe to message events, guild state comes from the GUI client's own sessions
+    intents = discord.Intents.none()
+    intents.guild_messages = True
+    intents.dm_messages = True
+    client = WorkerClient(conn, loop=loop, shard_ids=shard_ids, shard_count=shard_count,
+                          intents=intents,
+                          member_cache_flags=discord.MemberCacheFlags.none(),
+                          chunk_guilds_at_startup=False, max_messages=None)
+    try:
+        loop.run_until_complete(client.start(token, bot=True))
+    finally:
+        conn.close()
+        loop.close()
+
+
+class Cluster(object):
+    """
+    Moves message traffic of a bot account to worker processes. The workers
+    receive, decompress and decode the message events on their own cores
+    and send only those over a local socket. There they go through the GUI
+    client's parsers as if its own gateway had received them.
+    Guild and channel state is not moved: the GUI client still connects
+    every shard with the guilds intent and parses every GUILD_CREATE
+    itself, so startup cost for many guilds stays in the GUI process.
+    Every shard is identified twice, once by the GUI client and once by
+    its worker, which spends two of the bot's daily session starts
+    """
+
+    def __init__(self, app, workers):
+        self.app = app
+        self.workers = workers
+        self.shard_count = None
+        self.ranges = list()
+        self.processes = list()
+        self.stats = dict()  # shard id -> (latency, events per second)
+        self.workerOf = dict()  # shard id -> worker pid
+        self.listener = None
+        self.lock = threading.Lock()
+        self.queue = list()
+        self.scheduled = False
+
+    async def start(self, token):
+        self.shard_count = await recommended_shards(token)
+        self.ranges = shard_ranges(self.shard_count, self.workers)
+        authkey = os.urandom(32)
+        self.listener = Listener(("127.0.0.1", 0), authkey=authkey)
+        context = multiprocessing.get_context("spawn")
+        for shard_ids in self.ranges:
+            process = context.Process(target=run_worker, daemon=True,
+                                      args=(token, shard_ids, self.shard_count, self.listener.address, authkey))
+            process.start()
+            self.processes.append(process)
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        if self.listener is not None:
+            self.listener.close()
+
+    def accept(self):
+        for _ in self.processes:
+            try:
+                conn = self.listener.accept()
+            except (OSError, multiprocessing.AuthenticationError) as e:
+                print(e)
+                continue
+            threading.Thread(target=self.receive, args=(conn,), daemon=True).start()
+
+    def receive(self, conn):
+        """Reader thread of one worker, events are handed to the loop in batches"""
+        while True:
+            try:
+                event = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                self.queue.append(event)
+                if self.scheduled:
+                    continue
+                self.scheduled = True
+            self.app.clientThread.loop.call_soon_threadsafe(self.flush)
+
+    def flush(self):
+        with self.lock:
+            events, self.queue = self.queue, list()
+            self.scheduled = False
+        stats = False
+        for event in events:
+            if event["t"] == "CLUSTER_STATS":
+                self.stats.update(event["d"])
+                self.workerOf.update(dict.fromkeys(event["d"].keys(), event["pid"]))
+                stats = True
+            else:
+                parser = self.app.client._connection.parsers.get(event["t"])
+                if parser is not None:
+                    try:
+                        parser(event["d"])
+                    except Exception as e:
+                        print(e)
+        if stats:
+            self.app.bus.post(self.app.on_cluster_stats)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from copy import deepcopy
+import threading
+import asyncio
+import json
+import os
+
+# Load tests and multiple installs can point the client at another config directory
+cfgdir = os.environ.get("PESTERCHUM_CONFIG_DIR", "cfg")
+
+
+def atomic_write(path, text):
+    """Write `text` to a temporary file and rename it over `path`, so readers never see a partial file"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class ConfigFile(object):
+    """
+    A JSON config file held in memory. Changes are marked with `changed` and
+    written behind on the event loop's executor, at most one write every
+    `delay` seconds. Every write is of a numbered snapshot, and one older
+    than the last written is skipped, so a write-behind still running can't
+    replace the file after a newer `save`. Subclasses validate loaded data
+    in `validate`
+    """
+
+    def __init__(self, path, default, delay=2):
+        self.path = path
+        self.default = default
+        self.delay = delay
+        self.handle = None
+        self.writing = None
+        self.lock = threading.Lock()
+        self.serial = 0  # last snapshot taken
+        self.written = 0  # last snapshot written
+        self.data = self.load()
+
+    def loads(self, text):
+        return json.loads(text)
+
+    def dumps(self, data):
+        return json.dumps(data, indent=4)
+
+    def validate(self, data):
+        return data
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return self.validate(self.loads(f.read()))
+        except (OSError, ValueError):
+            # Missing or corrupt, start over from the defaults
+            data = self.validate(deepcopy(self.default))
+            self.data = data
+            self.write(self.snapshot())
+            return data
+
+    def snapshot(self):
+        self.serial += 1
+        return self.serial, self.dumps(self.data)
+
+    def write(self, snapshot):
+        serial, text = snapshot
+        with self.lock:
+            if serial <= self.written:
+                return  # A newer snapshot is already on disk
+            atomic_write(self.path, text)
+            self.written = serial
+
+    def changed(self):
+        """Schedule a write of the current data, repeated calls before it runs share it"""
+        if self.handle is None:
+            self.handle = asyncio.get_event_loop().call_later(self.delay, self.flush)
+
+    def flush(self):
+        self.handle = None
+        if self.writing is not None and not self.writing.done():
+            # Don't race the write still in progress
+            return self.changed()
+        self.writing = asyncio.get_event_loop().run_in_executor(None, self.write, self.snapshot())
+
+    def save(self):
+        """Write the current data now, used on exit"""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.write(self.snapshot())
@@ -20,24 +20,138 @@
 # DEALINGS IN THE SOFTWARE.
 
 from asyncio import ensure_future
+from bisect import bisect_left
 from contextlib import redirect_stdout
 from inspect import isawaitable
-from io import StringIO, BytesIO
+from io import StringIO
 from sys import exit as sysexit
 from traceback import format_exc
+import time
 
 import discord
 import simpleaudio as sa
 from PyQt5 import uic
-from PyQt5.QtCore import Qt, pyqtSlot, QUrl
+from PyQt5.QtCore import Qt, pyqtSlot, QUrl, QTimer
 from PyQt5.QtGui import QIcon, QTextCursor, QStandardItem, QColor, QBrush, QTextDocument, QImage
-from PyQt5.QtWidgets import QDialog, QWidget, QListWidgetItem, QComboBox, QHeaderView, QTableWidgetItem, QAction, QMenu
+from PyQt5.QtWidgets import QDialog, QWidget, QListWidgetItem, QComboBox, QHeaderView, QTableWidgetItem, QAction, QMenu, \
+    QTableWidget, QVBoxLayout, QTabWidget, QPushButton, QFileDialog
 from async_timeout import timeout
 
 from formatting import *
 
 
-class PrivateMessageWidget(QWidget):
+class ChatDisplay(object):
+    """
+    Display box behaviour shared by PrivateMessageWidget and MemoMessageWidget,
+    including the local echoes of messages waiting in the `Outbox`.
+    Every displayed message is tracked by id with a cursor kept at its start,
+    so it can be edited or removed in place, and history and live messages
+    can arrive in any order without duplicates.
+    Messages are marked up with classes from the stylesheet shared by every
+    display, re-applied only when a new class was added to it
+    """
+
+    def apply_styles(self):
+        formatter = self.app.formatter
+        if self.styleVersion != formatter.version:
+            self.userOutput.document().setDefaultStyleSheet(formatter.stylesheet)
+            self.styleVersion = formatter.version
+
+    def display_text(self, msg):
+        '''Insert msg into the display box'''
+        self.apply_styles()
+        with self.app.metrics.time("message.insert"):
+            cursor = self.userOutput.textCursor()
+            cursor.movePosition(QTextCursor.End)
+            self.userOutput.setTextCursor(cursor)
+            self.userOutput.insertHtml(fmt_markdown(msg))
+
+    def display_message(self, message):
+        """Insert a `discord.Message` in id order, dropped if it is already displayed"""
+        if message.id in self.entries:
+            return
+        fmt = self.app.format_message(message)
+        if not fmt:
+            return
+        document = self.userOutput.document()
+        before = document.characterCount()
+        idx = bisect_left(self.order, message.id)
+        if idx == len(self.order):
+            position = before - 1
+            self.display_text(fmt)
+        else:
+            # Older than something displayed, goes in front of the next message
+            position = self.entries[self.order[idx]][0].position()
+            cursor = QTextCursor(document)
+            cursor.setPosition(position)
+            self.apply_styles()
+            with self.app.metrics.time("message.insert"):
+                cursor.insertHtml(fmt_markdown(fmt))
+        marker = QTextCursor(document)
+        marker.setPosition(position)
+        self.order.insert(idx, message.id)
+        self.entries[message.id] = [marker, document.characterCount() - before]
+
+    def update_message(self, message):
+        """Re-render an edited message in place"""
+        entry = self.entries.get(message.id)
+        if entry is not None:
+            entry[1] = self.replace_range(entry[0], entry[1], self.app.format_message(message))
+
+    def remove_message(self, message_id):
+        entry = self.entries.pop(message_id, None)
+        if entry is not None:
+            self.replace_range(entry[0], entry[1], None)
+            del self.order[bisect_left(self.order, message_id)]
+
+    def replace_range(self, marker, length, msg):
+        """
+        Replace the `length` characters from `marker` with `msg`, or remove
+        them if it is None. Returns the new length, `marker` stays at the start
+        """
+        document = self.userOutput.document()
+        start = marker.position()
+        before = document.characterCount()
+        marker.setPosition(start + length, QTextCursor.KeepAnchor)
+        marker.removeSelectedText()
+        if msg:
+            self.apply_styles()
+            marker.insertHtml(fmt_markdown(msg))
+        marker.setPosition(start)
+        return length + document.characterCount() - before
+
+    def display_echo(self, nonce, msg):
+        """
+        Display a message that hasn't been sent yet. A cursor is kept at its
+        start, Qt moves it along as the document changes before it
+        """
+        document = self.userOutput.document()
+        before = document.characterCount()
+        self.display_text(msg)
+        marker = QTextCursor(document)
+        marker.setPosition(before - 1)
+        self.echoes[nonce] = (marker, document.characterCount() - before)
+
+    def reconcile_echo(self, nonce, msg, message=None, pending=False):
+        """
+        Replace the local echo of `nonce` with `msg`, the sent message or a
+        failure notice. The sent `message` takes over the echo's place. A
+        `pending` notice can itself be replaced later, by the sent message
+        """
+        echo = self.echoes.pop(nonce, None)
+        if echo is None:
+            return False
+        marker, length = echo
+        length = self.replace_range(marker, length, msg)
+        if pending:
+            self.echoes[nonce] = (marker, length)
+        if message is not None and message.id not in self.entries:
+            self.order.insert(bisect_left(self.order, message.id), message.id)
+            self.entries[message.id] = [marker, length]
+        return True
+
+
+class PrivateMessageWidget(ChatDisplay, QWidget):
     def __init__(self, app, parent, user, name):
         """
         The widget within each tab of TabWindow, a display
@@ -48,6 +162,10 @@ class PrivateMessageWidget(QWidget):
         self.user = user
         self.app = app
         self.parent = parent
+        self.echoes = dict()
+        self.entries = dict()  # message id -> [start cursor, length]
+        self.order = list()  # displayed message ids, sorted
+        self.styleVersion = None
 
         # setattr(user, "display_name", friend)
         self.userLabel.setText(name.join(["::", "::"]))
@@ -67,52 +185,30 @@ class PrivateMessageWidget(QWidget):
         urlstr = url.toString()
         if urlstr.startswith("mention="):
             id = urlstr[8:]
-            user = discord.utils.get(self.app.client.get_all_members(), id=int(id))
-            if user.id != self.app.client.user.id:
+            user = self.app.members.get(int(id))
+            if user is not None and user.id != self.app.client.user.id:
                 self.app.gui.start_privmsg(user)
         elif urlstr.startswith("channel="):
             id = urlstr[8:]
-            channel = discord.utils.get(self.memo.guild.channels, id=int(id))
-            if channel.id != self.memo.id:
+            channel = self.memo.guild.get_channel(int(id))
+            if channel is not None and channel.id != self.memo.id:
                 self.parent.tabWidget.setCurrentIndex(self.parent.channels.index(channel))
         elif urlstr.startswith("role="):
             pass
 
     async def get_logs(self):
-        ms = ""
-        for message in reversed(await self.user.history(limit=100).flatten()):
-            fmt = fmt_disp_msg(self.app, message.content, message, user=message.author)
-            ms += fmt
-        self.display_text(ms)
+        history = await self.app.prefetcher.history(self.user, self.app.history_limit)
+        for message in history:
+            self.display_message(message)
         sa.WaveObject.from_wave_file(os.path.join(self.app.theme["path"], "alarm.wav")).play()
 
     def send(self):
         """Send the user the message in the userInput box, called on enter press / send button press"""
         msg = self.userInput.text()
         if msg:
-            self.app.send_msg(msg, self.user)
+            self.app.send_msg(msg, self.user, self)
             self.userInput.setText("")
 
-    def display_text(self, msg):
-        '''Insert msg into the display box'''
-        msg = msg.replace("\n", "<br />")
-        while msg.count("**") % 2 == 0 and msg.count("**") > 0:
-            msg = msg.replace("**", "<strong>", 1)
-            msg = msg.replace("**", "</strong>", 1)
-
-        while msg.count("*") % 2 == 0 and msg.count("*") > 0:
-            msg = msg.replace("*", "<i>", 1)
-            msg = msg.replace("*", "</i>", 1)
-
-        while msg.count("```") % 2 == 0 and msg.count("```") > 0:
-            msg = msg.replace("```", "<code>", 1)
-            msg = msg.replace("```", "</code>", 1)
-
-        cursor = self.userOutput.textCursor()
-        cursor.movePosition(QTextCursor.End)
-        self.userOutput.setTextCursor(cursor)
-        self.userOutput.insertHtml(msg)
-
     def keyPressEvent(self, event):
         '''Use enter key to send'''
         if event.key() == Qt.Key_Return:
@@ -129,31 +225,39 @@ class TabWindow(QWidget):
         self.parent = parent
         self.app = app
         uic.loadUi(app.theme["ui_path"] + "/TabWindow.ui", self)
-        self.users = []
-        self.ids = []
         self.init_user = self.add_user(user)
         self.tabWidget.removeTab(0)  # Remove two default tabs
         self.tabWidget.removeTab(0)
         self.tabWidget.setTabsClosable(True)
         self.tabWidget.tabCloseRequested.connect(self.closeTab)
+        self.tabWidget.currentChanged.connect(self.mark_read)
+        self.mark_read(self.tabWidget.currentIndex())  # The first tab is shown without a currentChanged
         self.setWindowTitle("Private Message")
-        self.setWindowIcon(QIcon(app.theme["path"] + "/trayicon.png"))
+        self.setWindowIcon(app.assets.icon("trayicon.png"))
         self.show()
 
     def closeTab(self, currentIndex):
         widget = self.tabWidget.widget(currentIndex)
+        self.app.router.remove(widget.user.id, widget)
         widget.deleteLater()
         self.tabWidget.removeTab(currentIndex)
-        self.users.remove(widget.user)
-        if not self.users:
+        if not self.tabWidget.count():
             self.close()
 
         sa.WaveObject.from_wave_file(os.path.join(self.app.theme["path"], "cease.wav")).play()
 
     def closeEvent(self, event):
+        for idx in range(self.tabWidget.count()):
+            widget = self.tabWidget.widget(idx)
+            self.app.router.remove(widget.user.id, widget)
         event.accept()
         self.app.gui.tabWindow = None
 
+    def mark_read(self, idx):
+        widget = self.tabWidget.widget(idx)
+        if widget is not None:
+            self.app.buffers.mark_read(widget.user)
+
     def add_user(self, user):
         """
         Add a user & PrivateMessageWidget to window, check if it is already there
@@ -163,7 +267,8 @@ class TabWindow(QWidget):
         :rtype: `PrivateMessageWidget`
         :param user: The `discord.User` to message
         """
-        if user.id not in self.ids:
+        tab = self.app.router.get(user.id)
+        if tab is None:
             if isinstance(user, discord.User):
                 name = user.display_name
             elif isinstance(user, discord.GroupChannel):
@@ -175,14 +280,11 @@ class TabWindow(QWidget):
                 name = user.recipient.display_name
 
             windw = PrivateMessageWidget(self.app, self, user, name)
-            icon = QIcon("resources/pc_chummy.png")
+            icon = self.app.assets.file_icon("resources/pc_chummy.png")
             a = self.tabWidget.addTab(windw, icon, name)
             tab = self.tabWidget.widget(a)
-            self.users.append(user)
-            self.ids.append(user.id)
-            return tab
-        else:
-            return self.tabWidget.widget(self.ids.index(user.id))
+            self.app.router.add(user.id, tab)
+        return tab
 
 
 class AddFriendDialog(QDialog):
@@ -195,7 +297,7 @@ class AddFriendDialog(QDialog):
         self.app = app
         uic.loadUi(self.app.theme["ui_path"] + "/AddFriendDialog.ui", self)
         self.setWindowTitle('Add Chum')
-        self.setWindowIcon(QIcon(app.theme["path"] + "/trayicon.png"))
+        self.setWindowIcon(app.assets.icon("trayicon.png"))
         self.acceptButton.clicked.connect(self.accepted)
         self.rejectButton.clicked.connect(self.close)
         self.exec_()
@@ -218,7 +320,7 @@ class AddBlockedDialog(QDialog):
         self.app = app
         uic.loadUi(self.app.theme["ui_path"] + "/AddBlockedDialog.ui", self)
         self.setWindowTitle('TROLLSLUM')
-        self.setWindowIcon(QIcon(app.theme["path"] + "/trayicon.png"))
+        self.setWindowIcon(app.assets.icon("trayicon.png"))
         self.acceptButton.clicked.connect(self.accepted)
         self.rejectButton.clicked.connect(self.close)
         self.exec_()
@@ -230,10 +332,6 @@ class AddBlockedDialog(QDialog):
             self.app.add_blocked(user)
             item = QListWidgetItem(user)
             self.parent.blockedList.addItem(item)
-            if user in self.app.friends.keys():
-                index = self.app.gui.chumsTree.indexOfTopLevelItem(self.app.gui.getFriendItem(user)[0])
-                self.app.gui.chumsTree.takeTopLevelItem(index)
-
             self.close()
         else:
             self.close()
@@ -246,7 +344,7 @@ class BlockedDialog(QDialog):
         self.app = app
         self.parent = parent
         self.setWindowTitle('TROLLSLUM')
-        self.setWindowIcon(QIcon(app.theme["path"] + "/trayicon.png"))
+        self.setWindowIcon(app.assets.icon("trayicon.png"))
         self.addBlockButton.clicked.connect(self.add)
         self.removeBlockButton.clicked.connect(self.remove)
         for user in self.app.blocked:
@@ -264,11 +362,6 @@ class BlockedDialog(QDialog):
             self.blockedList.takeItem(index.row())
             user = item.text()
             self.app.blocked.remove(user)
-            if user in self.app.friends.keys():
-                treeitem = QStandardItem(user)
-                treeitem.setText(user)
-                treeitem.setIcon(QIcon(self.app.theme["path"] + "/offline.png"))
-                self.app.gui.friendsModel.appendRow(treeitem)
 
 
 class OptionsWindow(QWidget):
@@ -278,7 +371,7 @@ class OptionsWindow(QWidget):
         self.app = app
         self.parent = parent
         self.setWindowTitle('Options')
-        self.setWindowIcon(QIcon(app.theme["path"] + "/trayicon.png"))
+        self.setWindowIcon(app.assets.icon("trayicon.png"))
         self.options = self.app.options
         width = self.frameGeometry().width()
         height = self.frameGeometry().height()
@@ -332,36 +425,35 @@ class OptionsWindow(QWidget):
 
     def saveConfig(self):
         oldtheme = self.app.theme_name
+        # Each changed option notifies the app, which applies just that change
+        # Chum List
+        self.options.set("chum_list", "hide_offline_chums", self.hideOfflineRadio.isChecked())
+        self.options.set("chum_list", "show_empty_groups", self.showEmptyRadio.isChecked())
+        self.options.set("chum_list", "show_number_of_online_chums", self.showNumberRadio.isChecked())
+        self.options.set("chum_list", "sort_chums", self.sortChumsCombo.currentIndex())
+        self.options.set("chum_list", "low_bandwidth", self.lowBandwidthRadio.isChecked())
+        # Conversations
+        self.options.set("conversations", "time_stamps", self.timeStampsRadio.isChecked())
+        self.options.set("conversations", "show_seconds", self.showSecondsRadio.isChecked())
+        self.options.set("conversations", "op_and_voice_in_memos", self.opVoiceMemoRadio.isChecked())
+        self.options.set("conversations", "use_animated_smilies", self.animatedSmiliesRadio.isChecked())
+        self.options.set("conversations", "receive_random_encounters", self.randomEncountersRadio.isChecked())
+        self.options.set("conversations", "clock_type", self.clockTypeComboBox.currentIndex())
+        # Interface
+        self.options.set("interface", "tabbed_conversations", self.tabbedConvoBox.isChecked())
+        self.options.set("interface", "tabbed_memos", self.tabbedMemoBox.isChecked())
+        self.options.set("interface", "blink_taskbar_on_pesters", self.blinkPesterBox.isChecked())
+        self.options.set("interface", "blink_taskbar_on_memos", self.blinkMemoBox.isChecked())
+        self.options.set("interface", "minimize", self.minimizeCombo.currentIndex())
+        self.options.set("interface", "close", self.closeCombo.currentIndex())
+        # Updates
+        self.options.set("interface", "auto_update", self.pesterchumUpdatesCheck.isChecked())
+        # Theme
         try:
-            # Chum List
-            self.options["chum_list"]["hide_offline_chums"] = self.hideOfflineRadio.isChecked()
-            self.options["chum_list"]["show_empty_groups"] = self.showEmptyRadio.isChecked()
-            self.options["chum_list"]["show_number_of_online_chums"] = self.showNumberRadio.isChecked()
-            self.options["chum_list"]["sort_chums"] = self.sortChumsCombo.currentIndex()
-            self.options["chum_list"]["low_bandwidth"] = self.lowBandwidthRadio.isChecked()
-            # Conversations
-            self.options["conversations"]["time_stamps"] = self.timeStampsRadio.isChecked()
-            self.options["conversations"]["show_seconds"] = self.showSecondsRadio.isChecked()
-            self.options["conversations"]["op_and_voice_in_memos"] = self.opVoiceMemoRadio.isChecked()
-            self.options["conversations"]["use_animated_smilies"] = self.animatedSmiliesRadio.isChecked()
-            self.options["conversations"]["receive_random_encounters"] = self.randomEncountersRadio.isChecked()
-            self.options["conversations"]["clock_type"] = self.clockTypeComboBox.currentIndex()
-            # Interface
-            self.options["interface"]["tabbed_conversations"] = self.tabbedConvoBox.isChecked()
-            self.options["interface"]["tabbed_memos"] = self.tabbedMemoBox.isChecked()
-            self.options["interface"]["blink_taskbar_on_pesters"] = self.blinkPesterBox.isChecked()
-            self.options["interface"]["blink_taskbar_on_memos"] = self.blinkMemoBox.isChecked()
-            self.options["interface"]["minimize"] = self.minimizeCombo.currentIndex()
-            self.options["interface"]["close"] = self.closeCombo.currentIndex()
-            # Updates
-            self.options["interface"]["auto_update"] = self.pesterchumUpdatesCheck.isChecked()
-
-            self.app.change_theme(self.themesComboBox.currentText())
-            # Theme
-            self.options["theme"]["theme"] = self.themesComboBox.currentText()
+            self.options.set("theme", "theme", self.themesComboBox.currentText())
         except Exception as e:
             self.errorLabel.setText("Error changing theme: \n{}".format(e))
-            self.app.change_theme(oldtheme)
+            self.options.set("theme", "theme", oldtheme)
             print(e)
 
         self.close()
@@ -384,24 +476,30 @@ class MemosWindow(QWidget):
         self.app = app
         self.parent = parent
         self.setWindowTitle('Memos')
-        self.setWindowIcon(QIcon(app.theme["path"] + "/trayicon.png"))
+        self.setWindowIcon(app.assets.icon("trayicon.png"))
         # width = self.frameGeometry().width()
         # height = self.frameGeometry().height()
         # self.setFixedSize(width, height)
-        self.memosTableWidget.setColumnCount(2)
-        self.memosTableWidget.setHorizontalHeaderLabels(["Memo", "Users"])
+        self.memosTableWidget.setColumnCount(3)
+        self.memosTableWidget.setHorizontalHeaderLabels(["Memo", "Users", "Unread"])
         self.memosTableWidget.doubleClicked.connect(self.openMemo)
         header = self.memosTableWidget.horizontalHeader()
         header.setSectionResizeMode(QHeaderView.Stretch)
         self.ctr = 0
         self.open = dict()
-        for guild in self.app.client.guilds:
-            self.add_channel(guild.name, len(guild.members))
-        self.memosTableWidget.sortItems(0)
+        self.guilds = dict()  # guild name -> Guild
+        self.unreadItems = dict()  # guild id -> unread counter cell
         self.joinMemoButton.clicked.connect(self.join_button)
+        ensure_future(self.populate())
 
         self.show()
 
+    async def populate(self):
+        guilds = await self.app.read_client(lambda: self.app.client.guilds)
+        for guild in guilds:
+            self.add_channel(guild)
+        self.memosTableWidget.sortItems(0)
+
     def join_button(self):
         try:
             name = self.memoNameLineEdit.text()
@@ -419,15 +517,11 @@ class MemosWindow(QWidget):
             import traceback
             traceback.print_exc()
 
-    def display_message(self, channel, message):
-        win = self.getWindow(channel.guild)
-        win.display_message(channel, message)
-
     def getWindow(self, guild):
         if isinstance(guild, discord.Guild):
             return self.open[guild]
         elif isinstance(guild, str):
-            return discord.utils.get(self.app.client.guilds, name=guild)
+            return self.guilds.get(guild)
         else:
             return None
 
@@ -435,30 +529,61 @@ class MemosWindow(QWidget):
         if index.column():
             index = index.sibling(index.row(), 0)
         item = self.memosTableWidget.itemFromIndex(index)
-        guild = discord.utils.get(self.app.client.guilds, name=item.text())
-        tab = MemoTabWindow(self.app, self, guild)
-        self.open[guild] = tab
-        return tab.memo
+        ensure_future(self.open_memo(self.guilds[item.text()]))
+
+    async def open_memo(self, guild):
+        channels, writable = await self.app.read_client(memo_channels, guild)
+        self.open[guild] = MemoTabWindow(self.app, self, guild, channels, writable)
 
-    def add_channel(self, memo, usercount):
+    def add_channel(self, guild):
+        self.guilds[guild.name] = guild
         self.memosTableWidget.insertRow(self.ctr)
-        icn = QIcon(self.app.theme["path"] + "/memo.png")
-        mitem = QTableWidgetItem(icn, memo)
+        icn = self.app.assets.icon("memo.png")
+        mitem = QTableWidgetItem(icn, guild.name)
         mitem.setFlags(Qt.ItemFlags(Qt.ItemIsSelectable) | Qt.ItemFlags(Qt.ItemIsEnabled))
         uitem = QTableWidgetItem()
-        uitem.setData(0, usercount)
+        uitem.setData(0, guild.member_count)
         uitem.setTextAlignment(2)
         uitem.setFlags(Qt.ItemFlags(Qt.ItemIsSelectable) | Qt.ItemFlags(Qt.ItemIsEnabled))
+        nitem = QTableWidgetItem()
+        nitem.setTextAlignment(2)
+        nitem.setFlags(Qt.ItemFlags(Qt.ItemIsSelectable) | Qt.ItemFlags(Qt.ItemIsEnabled))
+        self.unreadItems[guild.id] = nitem
         self.memosTableWidget.setItem(self.ctr, 0, mitem)
         self.memosTableWidget.setItem(self.ctr, 1, uitem)
+        self.memosTableWidget.setItem(self.ctr, 2, nitem)
+        self.update_unread(guild)
         self.ctr += 1
 
+    def update_unread(self, guild):
+        item = self.unreadItems.get(guild.id)
+        if item is not None:
+            item.setText(fmt_unread(*self.app.buffers.guild_counts(guild)))
+
     def closeEvent(self, event):
         event.accept()
         self.app.gui.memosWindow = None
 
 
-class MemoMessageWidget(QWidget):
+def memo_channels(guild):
+    """
+    The text channels of `guild` the user can read, and the ids of those they
+    can send to. Checks permissions against the guild's roles, call it on the
+    client's thread
+    """
+    me = guild.me
+    channels = list()
+    writable = set()
+    for channel in guild.text_channels:
+        permissions = channel.permissions_for(me)
+        if permissions.read_messages:
+            channels.append(channel)
+            if permissions.send_messages:
+                writable.add(channel.id)
+    return channels, writable
+
+
+class MemoMessageWidget(ChatDisplay, QWidget):
     def __init__(self, app, container, parent, memo):
         """
         The widget within each tab of TabWindow, a display
@@ -466,21 +591,25 @@ class MemoMessageWidget(QWidget):
         """
         super(__class__, self).__init__()
         self.parent = parent
-        self.names = []
         uic.loadUi(app.theme["ui_path"] + "/MemoMessageWidget.ui", self)
         self.memo = memo
         self.app = app
         self.container = container
-        self.names = self.memo.guild.members
+        self.echoes = dict()
+        self.entries = dict()  # message id -> [start cursor, length]
+        self.order = list()  # displayed message ids, sorted
+        self.styleVersion = None
 
+        self.memoUsers.setModel(self.app.get_member_list(self.memo.guild))
+        self.memoUsers.setUniformItemSizes(True)
         self.memoUsers.setContextMenuPolicy(Qt.CustomContextMenu)
         self.memoUsers.customContextMenuRequested.connect(self.openMemoMenu)
         self.messageContext = QAction("MESSAGE")
         self.messageContext.triggered.connect(self.message_user)
         self.blockContext = QAction("BLOCK")
         self.blockContext.triggered.connect(self.block_user)
-        self.blockContext = QAction("UNBLOCK")
-        self.blockContext.triggered.connect(self.unblock_user)
+        self.removeBlockContext = QAction("UNBLOCK")
+        self.removeBlockContext.triggered.connect(self.unblock_user)
         self.friendContext = QAction("ADD FRIEND")
         self.friendContext.triggered.connect(self.send_friend_request)
         self.removeContext = QAction("REMOVE FRIEND")
@@ -492,22 +621,29 @@ class MemoMessageWidget(QWidget):
         self.userOutput.setMouseTracking(True)
         self.userOutput.anchorClicked.connect(self.anchorClicked)
         self.userOutput.setOpenLinks(False)
-        self.userOutput.document().setDefaultStyleSheet(self.app.theme["styles"])
         self.userOutput.setHtml("<body>\n</body>")
 
-        if not self.memo.permissions_for(self.memo.guild.me).send_messages:
+        if self.memo.id not in parent.writable:
             self.userInput.setReadOnly(True)
 
-        ensure_future(self.load_emojis())
-        ensure_future(self.get_logs())
+        self.tasks = [ensure_future(self.load_emojis()), ensure_future(self.get_logs())]
+
+    def unload(self):
+        """Stop fetching history and emojis, called before the widget is dropped for a placeholder"""
+        for task in self.tasks:
+            task.cancel()
 
     async def load_emojis(self):
+        if self.app.low_bandwidth:
+            return
         for emoji in self.memo.guild.emojis:
-            with timeout(10):
-                bop = BytesIO()
-                await emoji.url.save(bop)
+            # Emoji URLs change with their image, so the disk cache never needs revalidating
+            with timeout(10), self.app.metrics.time("emoji.fetch"):
+                response = await self.app.http.get(str(emoji.url), immutable=True)
+                if response.status != 200:
+                    continue
                 qmg = QImage()
-                qmg.loadFromData(bop.getvalue())
+                qmg.loadFromData(response.body)
                 self.userOutput.document().addResource(QTextDocument.ImageResource, QUrl(str(emoji.url)), qmg)
 
     @pyqtSlot(QUrl)
@@ -515,62 +651,44 @@ class MemoMessageWidget(QWidget):
         urlstr = url.toString()
         if urlstr.startswith("mention="):
             id = urlstr[8:]
-            user = discord.utils.get(self.app.client.get_all_members(), id=int(id))
-            if user.id != self.app.client.user.id:
+            user = self.app.members.get(int(id))
+            if user is not None and user.id != self.app.client.user.id:
                 self.app.gui.start_privmsg(user)
         elif urlstr.startswith("channel="):
             id = urlstr[8:]
-            channel = discord.utils.get(self.memo.guild.channels, id=int(id))
-            if channel.id != self.memo.id:
+            channel = self.memo.guild.get_channel(int(id))
+            if channel is not None and channel.id != self.memo.id:
                 self.parent.tabWidget.setCurrentIndex(self.parent.channels.index(channel))
         elif urlstr.startswith("role="):
             pass
 
     async def get_logs(self):
-        ms = ""
-        for message in reversed(await self.memo.history(limit=100).flatten()):
-            fmt = fmt_disp_msg(self.app, message.content, message, user=message.author)
-            ms += fmt
-        self.display_text(ms)
+        history = await self.app.prefetcher.history(self.memo, self.app.history_limit)
+        for message in history:
+            self.display_message(message)
 
     def send(self):
         """Send the user the message in the userInput box, called on enter press / send button press"""
         msg = self.userInput.text()
         if msg.strip():
-            self.app.send_msg(msg, self.memo)
+            self.app.send_msg(msg, self.memo, self)
             self.userInput.setText("")
 
-    def display_text(self, msg):
-        '''Insert msg into the display box'''
-        msg = msg.replace("\n", "<br />")
-        while msg.count("**") % 2 == 0 and msg.count("**") > 0:
-            msg = msg.replace("**", "<strong>", 1)
-            msg = msg.replace("**", "</strong>", 1)
-
-        while msg.count("*") % 2 == 0 and msg.count("*") > 0:
-            msg = msg.replace("*", "<i>", 1)
-            msg = msg.replace("*", "</i>", 1)
-
-        while msg.count("```") % 2 == 0 and msg.count("```") > 0:
-            msg = msg.replace("```", "<code>", 1)
-            msg = msg.replace("```", "</code>", 1)
-
-        cursor = self.userOutput.textCursor()
-        cursor.movePosition(QTextCursor.End)
-        self.userOutput.setTextCursor(cursor)
-        self.userOutput.insertHtml(msg)
-
     def keyPressEvent(self, event):
         '''Use enter key to send'''
         if event.key() == Qt.Key_Return:
             self.send()
 
+    def selected_member(self):
+        """Get the `discord.Member` selected in the memo user list, if any"""
+        selected = self.memoUsers.selectedIndexes()
+        if selected:
+            return self.memoUsers.model().member(selected[0])
+
     def openMemoMenu(self, position):
         menu = QMenu()
-        selected = self.memoUsers.selectedItems()
-        if selected:
-            user = selected[0].text()
-            member = self.memo.guild.get_member_named(user)
+        member = self.selected_member()
+        if member is not None:
             if self.app.client.user.bot and member is not self.memo.guild.me:
                 menu.addAction(self.messageContext)
 
@@ -593,71 +711,77 @@ class MemoMessageWidget(QWidget):
         menu.exec_(self.memoUsers.viewport().mapToGlobal(position))
 
     def message_user(self):
-        selected = self.memoUsers.selectedItems()
-        if selected:
-            user = selected[0].text()
-            member = self.memo.guild.get_member_named(user)
-            if member.id != self.app.client.user.id:
-                ensure_future(self.app.gui.start_pm(member))
+        member = self.selected_member()
+        if member is not None and member.id != self.app.client.user.id:
+            ensure_future(self.app.gui.start_pm(member))
 
     def block_user(self):
-        selected = self.memoUsers.selectedItems()
-        if selected:
-            user = selected[0].text()
-            member = self.memo.guild.get_member_named(user)
-            if member.id != self.app.client.user.id:
-                ensure_future(user.block())
+        member = self.selected_member()
+        if member is not None and member.id != self.app.client.user.id:
+            self.app.run_client(member.block())
 
     def unblock_user(self):
-        selected = self.memoUsers.selectedItems()
-        if selected:
-            user = selected[0].text()
-            member = self.memo.guild.get_member_named(user)
-            if member.id != self.app.client.user.id:
-                ensure_future(user.unblock())
+        member = self.selected_member()
+        if member is not None and member.id != self.app.client.user.id:
+            self.app.run_client(member.unblock())
 
     def send_friend_request(self):
-        selected = self.memoUsers.selectedItems()
-        if selected:
-            user = selected[0].text()
-            member = self.memo.guild.get_member_named(user)
-            if member.id != self.app.client.user.id:
-                ensure_future(user.send_friend_request())
+        member = self.selected_member()
+        if member is not None and member.id != self.app.client.user.id:
+            self.app.run_client(member.send_friend_request())
 
     def remove_friend(self):
-        selected = self.memoUsers.selectedItems()
-        if selected:
-            user = selected[0].text()
-            member = self.memo.guild.get_member_named(user)
-            if member.id != self.app.client.user.id:
-                ensure_future(user.remove_friend())
+        member = self.selected_member()
+        if member is not None and member.id != self.app.client.user.id:
+            self.app.run_client(member.remove_friend())
+
+
+class MemoPlaceholder(QWidget):
+    def __init__(self, memo):
+        """
+        Stand-in for a channel tab in MemoTabWindow whose MemoMessageWidget
+        hasn't been built yet, or was dropped after going idle
+        """
+        super(__class__, self).__init__()
+        self.memo = memo
 
 
 class MemoTabWindow(QWidget):
-    def __init__(self, app, parent, memo):
+    idle_timeout = 600  # Seconds before an unviewed channel is dropped to a placeholder
+    idle_interval = 60000  # Milliseconds between idle checks
+
+    def __init__(self, app, parent, memo, channels, writable):
         """
-        A window for storing PrivateMessageWidget instances, a navigation
-        between current private message users
+        A window for storing MemoMessageWidget instances, one tab per channel.
+        Tabs start as placeholders and are only built when first shown.
+        `channels` and `writable` are as returned by `memo_channels`
         """
         super(__class__, self).__init__()
         self.parent = parent
         self.app = app
         uic.loadUi(app.theme["ui_path"] + "/MemoTabWindow.ui", self)
         self.memo = memo
+        self.lastActive = dict()
 
-        # Filter channels by read permission
-        self.channels = list(filter(lambda x: x.permissions_for(x.guild.me).read_messages, self.memo.text_channels))
+        self.channels = channels
+        self.writable = writable
 
         # Remove two default tabs
         self.tabWidget.removeTab(0)
         self.tabWidget.removeTab(0)
 
         self.setWindowTitle("Memos")
-        self.setWindowIcon(QIcon(self.app.theme["path"] + "/memo.png"))
+        self.setWindowIcon(self.app.assets.icon("memo.png"))
         for channel in self.channels:
             self.add_memo(channel)
 
-        self.add_user_items()
+        self.tabWidget.currentChanged.connect(self.activate)
+        if self.channels:
+            self.activate(self.tabWidget.currentIndex())
+
+        self.idleTimer = QTimer(self)
+        self.idleTimer.timeout.connect(self.drop_idle)
+        self.idleTimer.start(self.idle_interval)
 
         self.show()
         sa.WaveObject.from_wave_file(os.path.join(self.app.theme["path"], "alarm2.wav")).play()
@@ -665,44 +789,67 @@ class MemoTabWindow(QWidget):
     def closeEvent(self, event):
         """On window (or tab) close send a PESTERCHUM:CEASE message to each user, destroy self"""
         del self.parent.open[self.memo]
+        self.idleTimer.stop()
+        for idx in range(self.tabWidget.count()):
+            widget = self.tabWidget.widget(idx)
+            if isinstance(widget, MemoMessageWidget):
+                self.app.router.remove(widget.memo.id, widget)
+                widget.unload()
+        memberList = self.app.memberLists.pop(self.memo.id, None)
+        if memberList is not None:
+            memberList.task.cancel()
+            memberList.updates.cancel()
         event.accept()
         sa.WaveObject.from_wave_file(os.path.join(self.app.theme["path"], "cease.wav")).play()
 
-    def display_message(self, channel, message):
-        self.getWidget(channel).display_text(message)
-
-    def getWidget(self, guild):
-        try:
-            idx = self.channels.index(guild)
-            return self.tabWidget.widget(idx)
-        except IndexError as e:
-            print(e)
-
     def add_memo(self, memo):
-        '''
-        Add a user & PrivateMessageWidget to window, check if it is already there
-        if so, return that user's PM, if not, create and return a PM
-        On PrivateMessageWidget creation, send a PESTERCHUM:BEGIN initiation message
-        '''
-        windw = MemoMessageWidget(self.app, self.tabWidget, self, memo)
-        icon = QIcon(self.app.theme["path"] + "/memo.png")
-        a = self.tabWidget.addTab(windw, icon, memo.name)
+        '''Add a placeholder tab for the channel `memo`, built into a MemoMessageWidget when first shown'''
+        icon = self.app.assets.icon("memo.png")
+        a = self.tabWidget.addTab(MemoPlaceholder(memo), icon, memo.name)
         tab = self.tabWidget.widget(a)
         return tab
 
-    def add_user_items(self):
-        for member in sorted(self.memo.members,
-                             key=lambda x: (max([r.position for r in x.roles if r.hoist], default=0), x.display_name),
-                             reverse=True):
-            nam = QListWidgetItem(member.display_name)
-            clra = member.color
-            clr = QBrush()
-            clr.setColor(QColor(clra.r, clra.g, clra.b))
-            nam.setForeground(clr)
-            if member.top_role.permissions.administrator:
-                nam.setIcon(QIcon(self.app.theme["path"] + "/op.png"))
-            widget = self.tabWidget.widget(0)
-            widget.memoUsers.addItem(nam)
+    def replace_tab(self, idx, widget):
+        """Swap the widget of tab `idx` without emitting currentChanged"""
+        old = self.tabWidget.widget(idx)
+        icon = self.tabWidget.tabIcon(idx)
+        text = self.tabWidget.tabText(idx)
+        current = self.tabWidget.currentIndex()
+        self.tabWidget.blockSignals(True)
+        self.tabWidget.removeTab(idx)
+        self.tabWidget.insertTab(idx, widget, icon, text)
+        self.tabWidget.setCurrentIndex(current)
+        self.tabWidget.blockSignals(False)
+        old.deleteLater()
+        return widget
+
+    def activate(self, idx):
+        '''Build the MemoMessageWidget of tab `idx` if it is still a placeholder'''
+        widget = self.tabWidget.widget(idx)
+        if widget is None:
+            return
+        self.lastActive[widget.memo.id] = time.monotonic()
+        self.app.buffers.mark_read(widget.memo)
+        if isinstance(widget, MemoPlaceholder):
+            widget = self.replace_tab(idx, MemoMessageWidget(self.app, self.tabWidget, self, widget.memo))
+            self.app.router.add(widget.memo.id, widget)
+
+    def drop_idle(self):
+        '''Drop channels that haven't been viewed in `idle_timeout` seconds back to placeholders'''
+        now = time.monotonic()
+        current = self.tabWidget.currentIndex()
+        widget = self.tabWidget.widget(current)
+        if widget is not None:
+            # Still being viewed, its idle time starts when the user leaves it
+            self.lastActive[widget.memo.id] = now
+        for idx in range(self.tabWidget.count()):
+            widget = self.tabWidget.widget(idx)
+            if idx == current or not isinstance(widget, MemoMessageWidget):
+                continue
+            if now - self.lastActive.get(widget.memo.id, 0) > self.idle_timeout:
+                self.app.router.remove(widget.memo.id, widget)
+                widget.unload()
+                self.replace_tab(idx, MemoPlaceholder(widget.memo))
 
 
 class AuthDialog(QDialog):
@@ -717,7 +864,7 @@ class AuthDialog(QDialog):
         self.fin = False
         uic.loadUi(self.app.theme["ui_path"] + "/AuthDialog.ui", self)
         self.setWindowTitle('Auth')
-        self.setWindowIcon(QIcon(app.theme["path"] + "/trayicon.png"))
+        self.setWindowIcon(app.assets.icon("trayicon.png"))
         self.acceptButton.clicked.connect(self.accepted)
         self.acceptButton.setDefault(True)
         self.closeButton.clicked.connect(self.rejected)
@@ -769,7 +916,7 @@ class QuirksWindow(QWidget):
             self.quirksList.addItem("{}:{}".format(type, quirk))
 
         self.setWindowTitle('Quirks')
-        self.setWindowIcon(QIcon(app.theme["path"] + "/trayicon.png"))
+        self.setWindowIcon(app.assets.icon("trayicon.png"))
 
         self.show()
 
@@ -783,7 +930,7 @@ class QuirksWindow(QWidget):
         items = self.quirksList.selectedItems()
         for item in items:
             row = self.quirksList.indexFromItem(item).row()
-            self.app.quirks.quirks.pop(row)
+            self.app.quirks.pop(row)
             self.quirksList.takeItem(row)
 
     def closeWin(self):
@@ -805,7 +952,7 @@ class AddQuirkWindow(QWidget):
 
         self.buttons = ('opts', 'prefix', 'suffix', 'replace', 'regex', 'random')
         self.setWindowTitle('Quirks')
-        self.setWindowIcon(QIcon(app.theme["path"] + "/trayicon.png"))
+        self.setWindowIcon(app.assets.icon("trayicon.png"))
 
         enableNext = lambda: self.nextButton.setEnabled(True)
         self.nextButton.setEnabled(False)
@@ -930,7 +1077,7 @@ class ConnectingDialog(QDialog):
         self.setWindowFlags(Qt.FramelessWindowHint)
         self.connectingExitButton.clicked.connect(sysexit)
         self.setWindowTitle('Connecting')
-        self.setWindowIcon(QIcon(app.theme["path"] + "/trayicon.png"))
+        self.setWindowIcon(app.assets.icon("trayicon.png"))
         self.app.connectingDialog = self
         width = self.frameGeometry().width()
         height = self.frameGeometry().height()
@@ -958,14 +1105,12 @@ class InteractiveConsole(QWidget):
 
         self.userLabel.setText("::DEBUG::")
         self.setWindowTitle("Debug")
-        self.setWindowIcon(QIcon("resources/sburb.png"))
+        self.setWindowIcon(self.app.assets.file_icon("resources/sburb.png"))
         self.sendButton.clicked.connect(self.send)
         self.sendButton.setText("GO!")
         self.userOutput.setReadOnly(True)
         self.userOutput.setMouseTracking(True)
 
-        self.show()
-
     def send(self):
         msg = self.userInput.text()
         if msg:
@@ -1034,3 +1179,98 @@ class InteractiveConsole(QWidget):
                 self.display_text('Content too big to be printed.')
             else:
                 self.display_text(fmt)
+
+
+class MetricsWidget(QWidget):
+    def __init__(self, app):
+        """Live view of `App.metrics`, refreshed every second, with an export to JSON"""
+        super(__class__, self).__init__()
+        self.app = app
+        self.metricsTable = QTableWidget(self)
+        self.metricsTable.setColumnCount(7)
+        self.metricsTable.setHorizontalHeaderLabels(
+            ["Metric", "Count", "Mean (ms)", "p50 (ms)", "p90 (ms)", "p99 (ms)", "Max (ms)"])
+        self.metricsTable.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.exportButton = QPushButton("EXPORT", self)
+        self.exportButton.clicked.connect(self.export)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.metricsTable)
+        layout.addWidget(self.exportButton)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(1000)
+        self.refresh()
+
+    def refresh(self):
+        metrics = self.app.metrics.snapshot()
+        self.metricsTable.setRowCount(len(metrics))
+        for row, name in enumerate(sorted(metrics)):
+            metric = metrics[name]
+            values = [name, metric["count"]]
+            if "mean" in metric:
+                values += [round(metric[key] * 1000, 2) for key in ("mean", "p50", "p90", "p99", "max")]
+            for column in range(self.metricsTable.columnCount()):
+                item = QTableWidgetItem()
+                item.setData(Qt.DisplayRole, values[column] if column < len(values) else "")
+                item.setFlags(Qt.ItemFlags(Qt.ItemIsSelectable) | Qt.ItemFlags(Qt.ItemIsEnabled))
+                self.metricsTable.setItem(row, column, item)
+
+    def export(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export metrics", "metrics.json", "JSON (*.json)")
+        if path:
+            self.app.metrics.export(path)
+
+
+class DebugWindow(QTabWidget):
+    def __init__(self, app):
+        """The HELP > DEBUG window, a console tab and a metrics tab"""
+        super(__class__, self).__init__()
+        self.app = app
+        self.setWindowTitle("Debug")
+        self.setWindowIcon(self.app.assets.file_icon("resources/sburb.png"))
+        self.console = InteractiveConsole(app)
+        self.metrics = MetricsWidget(app)
+        self.addTab(self.console, "CONSOLE")
+        self.addTab(self.metrics, "METRICS")
+        self.show()
+
+    def closeEvent(self, event):
+        self.metrics.timer.stop()
+        event.accept()
+
+
+class ShardStatsWindow(QWidget):
+    def __init__(self, app):
+        """
+        Live latency and event rate of every shard of a cluster, refreshed
+        each time the workers report
+        """
+        super(__class__, self).__init__()
+        self.app = app
+        self.setWindowTitle("Shards")
+        self.setWindowIcon(app.assets.icon("trayicon.png"))
+        self.shardsTable = QTableWidget(self)
+        self.shardsTable.setColumnCount(4)
+        self.shardsTable.setHorizontalHeaderLabels(["Shard", "Worker", "Latency (ms)", "Events/s"])
+        self.shardsTable.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.shardsTable)
+        self.refresh()
+        self.show()
+
+    def refresh(self):
+        cluster = self.app.cluster
+        self.shardsTable.setRowCount(len(cluster.stats))
+        for row, shard in enumerate(sorted(cluster.stats)):
+            latency, rate = cluster.stats[shard]
+            values = (shard, cluster.workerOf.get(shard, ""),
+                      "" if latency is None else round(latency * 1000), round(rate, 1))
+            for column, value in enumerate(values):
+                item = QTableWidgetItem()
+                item.setData(Qt.DisplayRole, value)
+                item.setFlags(Qt.ItemFlags(Qt.ItemIsSelectable) | Qt.ItemFlags(Qt.ItemIsEnabled))
+                self.shardsTable.setItem(row, column, item)
+
+    def closeEvent(self, event):
+        event.accept()
+        self.app.gui.shardsWindow = None
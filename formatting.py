@@ -67,8 +67,8 @@ def fmt_me_msg(app, msg, user, time=False):
     suffix = me[3:]
     init = getInitials(app, user, c=True, suffix=suffix)
     predicate = msg[3 + len(suffix):].strip()
-    timefmt = '<span style="color:black;">[{}]</style>'.format(getTime(app)) if time else ""
-    fmt = '<b>{timefmt}<span style="color:#646464;"> -- {user}{suffix} {init} {predicate}--</span></b><br />'
+    timefmt = '<span class="ts">[{}]</span>'.format(getTime(app)) if time else ""
+    fmt = '<b>{timefmt}<span class="me"> -- {user}{suffix} {init} {predicate}--</span></b><br />'
     msg = fmt.format(user=user.display_name, init=init,
                      timefmt=timefmt if app.options["conversations"]["time_stamps"] else "", predicate=predicate,
                      suffix=suffix)
@@ -87,6 +87,88 @@ def html_escape(text):
     return "".join(html_escape_table.get(c,c) for c in text)
 
 
+def luma(r, g, b):
+    return 0.2126 * r + 0.7152 * g + 0.0722 * b
+
+
+def contrast_color(color, bgluma):
+    """Lighten a very dark color on a very dark background, or darken a very light one on a light background"""
+    r, g, b = parse_rgb_literal(color)
+    colorluma = luma(r, g, b)
+    if bgluma < 40 and colorluma < 40:
+        return rgbtohex(*(min(255, int(c * 1.5)) for c in (r, g, b)))
+    if bgluma > 215 and colorluma > 215:
+        return rgbtohex(*(int(c / 1.5) for c in (r, g, b)))
+    return color
+
+
+# Message classes every chat document knows, author colors are added per color
+base_styles = ".ts{color:black}.me{color:#646464}"
+
+
+class FormatContext(object):
+    """
+    Values `fmt_disp_msg` needs for every message, the background luma is
+    computed once per theme, and each author's initials and color class are
+    cached by (user id, display name, color).
+    Messages use classes instead of inline styles, each color gets a class
+    the first time it is seen. `stylesheet` is the one document stylesheet
+    shared by every chat display, `version` changes whenever it does
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.bgluma = None
+        self.authors = dict()  # (id, display name, color) -> (initials, color class)
+        self.keys = dict()  # user id -> set of keys, so an update can drop them
+        self.classes = dict()  # color -> class name
+        self.rules = list()
+        self.version = 0
+        self.sheet = (None, "")
+
+    def refresh(self):
+        """Called when the theme changes"""
+        self.bgluma = None
+        self.authors.clear()
+        self.keys.clear()
+        self.classes.clear()
+        self.rules.clear()
+        self.version += 1
+
+    def color_class(self, color):
+        cls = self.classes.get(color)
+        if cls is None:
+            cls = self.classes[color] = "c{}".format(len(self.classes))
+            self.rules.append(".{}{{color:{}}}".format(cls, color))
+            self.version += 1
+        return cls
+
+    @property
+    def stylesheet(self):
+        """The theme's rich text rules, the message classes and a rule per color class"""
+        if self.sheet[0] != self.version:
+            self.sheet = (self.version, "".join([self.app.theme["document_styles"], base_styles] + self.rules))
+        return self.sheet[1]
+
+    def author(self, user):
+        if self.bgluma is None:
+            bgcolor = self.app.gui.palette().color(QPalette.Background)
+            self.bgluma = luma(bgcolor.red(), bgcolor.green(), bgcolor.blue())
+        color = self.app.getColor(user)
+        key = (user.id, user.display_name, color)
+        cached = self.authors.get(key)
+        if cached is None:
+            cached = self.authors[key] = (getInitials(self.app, user, b=False),
+                                          self.color_class(contrast_color(color, self.bgluma)))
+            self.keys.setdefault(user.id, set()).add(key)
+        return cached
+
+    def invalidate(self, user):
+        """Drop everything cached for `user`, called when a member or user updates"""
+        for key in self.keys.pop(user.id, ()):
+            self.authors.pop(key, None)
+
+
 def fmt_disp_msg(app, msg, mobj, user=None):
     """Format a message for display"""
     msg = html_escape(msg)
@@ -99,17 +181,7 @@ def fmt_disp_msg(app, msg, mobj, user=None):
     else:
         msg = color_to_span(msg)
         time = format_time(app, mobj)
-        init = getInitials(app, user, b=False)
-        color = app.getColor(user)
-        bgcolor = app.gui.palette().color(QPalette.Background)
-        bgluma = 0.2126 * bgcolor.red() + 0.7152 * bgcolor.green() + 0.0722 * bgcolor.blue()
-        r, g, b = parse_rgb_literal(color)
-        colorluma = 0.2126 * r + 0.7152 * g + 0.0722 * b
-        if bgluma < 40 and colorluma < 40:
-            color = f"#{hex(int(r * 1.5))}{hex(int(g * 1.5))}{hex(int(g * 1.5))}"
-
-        if bgluma > 215 and colorluma > 215:
-            color = f"#{hex(r // 1.5)}{hex(g // 1.5)}{hex(g // 1.5)}"
+        init, cls = app.formatter.author(user)
 
         if str(msg).find("|") != -1:
             ## -- Spoiler tag magic -- ##
@@ -194,14 +266,37 @@ def fmt_disp_msg(app, msg, mobj, user=None):
             print("\n\n Input Message: " + msg)
             print("Output Message: " + msg)
 
-        fmt = '<b><span style="color:black;">{time} <span style="color:{color};">{init}: {msg}</span></span></b><br />'
+        fmt = '<b class="ts">{time} <span class="{cls}">{init}: {msg}</span></b><br />'
         msg = fmt.format(time="[" + time + "]" if app.options["conversations"]["time_stamps"] else "", init=init,
-                         msg=msg.strip(), color=color)
+                         msg=msg.strip(), cls=cls)
         msg = app.emojis.process_emojis(msg, mobj)
         msg = app.mentions.process_mentions(msg, mobj)
     return msg
 
 
+def fmt_markdown(msg):
+    """Convert newlines, **bold**, *italic* and ```code``` to HTML"""
+    msg = msg.replace("\n", "<br />")
+    # Markers are paired left to right, and only when every marker has a pair
+    for marker, tag in (("**", "strong"), ("*", "i"), ("```", "code")):
+        if msg.count(marker) % 2 == 0:
+            msg = re.sub(r"{0}(.*?){0}".format(re.escape(marker)), r"<{0}>\1</{0}>".format(tag), msg, flags=re.S)
+    return msg
+
+
+def fmt_send_error(msg, error, maybe_sent=False):
+    """Mark a message that failed to send, or that may not have been sent"""
+    return '{}<b><span style="color:#c00000;"> -- {}: {} --</span></b><br />'.format(
+        msg, "may not have been sent" if maybe_sent else "failed to send", html_escape(str(error)))
+
+
+def fmt_unread(unread, mentions):
+    """Unread counter label, '' when there is nothing unread"""
+    if mentions:
+        return "{} ({}@)".format(unread, mentions)
+    return str(unread) if unread else ""
+
+
 def fmt_img(src):
     return '<img src="{}"/>'.format(src)
 
@@ -235,7 +330,7 @@ def getInitials(app, user, b=True, c=False, suffix=None, prefix=None):
     else:
         fin = init
     if c:
-        fin = '<span style="color:{color}">{fin}</span>'.format(fin=fin, color=app.getColor(user))
+        fin = '<span class="{cls}">{fin}</span>'.format(fin=fin, cls=app.formatter.color_class(app.getColor(user)))
     return fin
 
 
@@ -249,7 +344,7 @@ def parse_rgb_literal(color):
         return int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16)
     color = color.strip("()rgb")
     colors = color.split(",")
-    return int(colors[0].strip(), 16), int(colors[1].strip(), 16), int(colors[2].strip(), 16)
+    return int(colors[0].strip()), int(colors[1].strip()), int(colors[2].strip())
 
 
 def isrgb(match):
@@ -263,13 +358,15 @@ def isrgb(match):
         return "rgb(" + s.strip('rgb()') + ")"
 
 
+digits = '0123456789abcdefABCDEF'
+hexdec = {v: int(v, 16) for v in (x + y for x in digits for y in digits)}
+
+
 def rgb(triplet, type=str):
     '''Converts hex triplet to RGB value tuple or string'''
     if hasattr(triplet, "group"):
         triplet = triplet.group(0)
     triplet = triplet.strip("#")
-    digits = '0123456789abcdefABCDEF'
-    hexdec = {v: int(v, 16) for v in (x + y for x in digits for y in digits)}
     if type == str:
         return "rgb" + str((hexdec[triplet[0:2]], hexdec[triplet[2:4]], hexdec[triplet[4:6]]))
     else:
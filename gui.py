@@ -19,10 +19,10 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
-from random import randint, choice
+from random import randint
 
-from PyQt5.QtCore import QModelIndex, QVariant
-from PyQt5.QtGui import QDesktopServices, QStandardItemModel
+from PyQt5.QtCore import QModelIndex
+from PyQt5.QtGui import QDesktopServices
 from PyQt5.QtWidgets import QMainWindow, QSystemTrayIcon, QTreeView
 
 from dialogs import *
@@ -38,16 +38,24 @@ class Gui(QMainWindow):
         self.tabWindow = None
         self.quirkWindow = None
         self.memosWindow = None
+        self.shardsWindow = None
         self.mood_buttons = dict()
+        self.initialized = False
 
     def initialize(self):
+        """
+        Build the window. Called again once the client is ready, which only
+        updates what depends on the logged in user: menus, actions and signal
+        connections are made once
+        """
+        if self.initialized:
+            self.show_name()
+            return
+        self.initialized = True
         uic.loadUi(self.theme["ui_path"] + "/Main.ui", self)
 
-        if self.app.client.user is not None:
-            self.nameButton.setText(self.app.client.user.name)
-        else:
-            self.nameButton.setText("")
-        self.nameButton.setIcon(QIcon(self.theme["path"] + "/chummy.png"))
+        self.show_name()
+        self.nameButton.setIcon(self.app.assets.icon("chummy.png"))
 
         # Fix dimensions
         width = self.frameGeometry().width()
@@ -97,20 +105,15 @@ class Gui(QMainWindow):
 
         if self.app.trayIcon is None:
             # Create a tray icon for the app so you can hide and unhide the app
-            self.app.trayIcon = QSystemTrayIcon(QIcon(self.app.theme["path"] + "/trayicon.png"), self.app)
+            self.app.trayIcon = QSystemTrayIcon(self.app.assets.icon("trayicon.png"), self.app)
             self.app.trayIcon.show()
         self.app.trayIcon.setContextMenu(self.clientMenu)
 
         # Set window info
         self.setWindowTitle('Pesterchum')
-        self.setWindowIcon(QIcon(self.theme["path"] + "/trayicon.png"))
+        self.setWindowIcon(self.app.assets.icon("trayicon.png"))
         self.setWindowFlags(Qt.FramelessWindowHint)
 
-        # Create QStandardItemModel for QTreeView
-        self.friendsItems = dict()
-        self.friendsUsers = dict()
-        self.friendsModel = self.FriendsModel(self.app)
-
         # Create HELP button in 'HELP' menu
         self.openHelpAction = QAction("HELP", self)
         self.openHelpAction.triggered.connect(self.openHelp)
@@ -126,31 +129,24 @@ class Gui(QMainWindow):
         self.openDebugAction.triggered.connect(self.openDebug)
         self.helpMenu.addAction(self.openDebugAction)
 
-        # Create a QStandardItem for each friend, friendsModel will auto update
-        for channel in self.app.client.private_channels:
-            if isinstance(channel, discord.GroupChannel):
-                if not channel.name:
-                    friend = ", ".join(map(lambda c: c.display_name, channel.recipients))
-                else:
-                    friend = channel.name
-            else:
-                friend = channel.recipient.display_name
-            self.friendsUsers[friend] = channel
-
-            treeitem = QStandardItem(friend)
-            treeitem.setText(friend)
-            treeitem.setIcon(QIcon(self.theme["path"] + "/{}.png".format(choice(self.app.moods.moods))))
-            self.friendsModel.appendRow(treeitem)
-            self.friendsItems[friend] = treeitem
-
-        self.friendsModel.sort(0)
-        self.chumsTree.setModel(self.friendsModel)
+        # Create SHARDS button in 'HELP' menu when running a cluster
+        if self.app.cluster is not None:
+            self.openShardsAction = QAction("SHARDS", self)
+            self.openShardsAction.triggered.connect(self.openShards)
+            self.helpMenu.addAction(self.openShardsAction)
+
+        # The chum list models live on the App and are updated from channel events
+        self.chumsTree.setModel(self.app.chumsProxy)
         self.chumsTree.doubleClicked.connect(self.open_privmsg)
         self.chumsTree.setContextMenuPolicy(Qt.CustomContextMenu)
         self.chumsTree.setSelectionMode(QTreeView.SingleSelection)
         self.chumsTree.setSelectionBehavior(QTreeView.SelectRows)
         self.chumsTree.setExpandsOnDoubleClick(True)
         self.chumsTree.setItemsExpandable(True)
+        # Pointing at or selecting a chum warms its history before it is opened
+        self.chumsTree.setMouseTracking(True)
+        self.chumsTree.entered.connect(self.hint_privmsg)
+        self.chumsTree.selectionModel().currentChanged.connect(lambda current, previous: self.hint_privmsg(current))
 
         self.pesterButton.clicked.connect(self.privmsg_pester)
         self.blockButton.clicked.connect(self.block_selected)
@@ -162,13 +158,22 @@ class Gui(QMainWindow):
                 button = getattr(self, name)
                 self.mood_buttons[num] = button
                 mood_name = self.app.moods.getName(num)
-                button.setIcon(QIcon(os.path.join(self.theme["path"], "{}.png".format(mood_name))))
+                button.setIcon(self.app.assets.icon(mood_name + ".png"))
                 button.clicked.connect(self.make_setMood(button))
 
         self.colorButton.setStyleSheet(
             'background-color: rgb({},{},{});'.format(randint(0, 255), randint(0, 255), randint(0, 255)))
 
         self.show()
+        # Decode the rest of the mood icons once the window has painted
+        QTimer.singleShot(0, lambda: ensure_future(
+            self.app.assets.preload([mood + ".png" for mood in self.app.moods.moods])))
+
+    def show_name(self):
+        if self.app.client.user is not None:
+            self.nameButton.setText(self.app.client.user.name)
+        else:
+            self.nameButton.setText("")
 
     # Methods for moving window
     @pyqtSlot()
@@ -189,31 +194,37 @@ class Gui(QMainWindow):
     def mouseReleaseEvent(self, event):
         self.offset = None
 
-    def privmsg_pester(self):
-        """Opens selected user in tree when PESTER! button pressed, same as double click"""
+    def channel_at(self, index):
+        """Get the private channel of an index of chumsTree"""
+        return self.app.chumsModel.channel(self.app.chumsProxy.mapToSource(index))
+
+    def hint_privmsg(self, index):
+        channel = self.channel_at(index)
+        if channel is not None:
+            self.app.prefetcher.hint(channel)
+
+    def selected_channel(self):
         selected = self.chumsTree.selectedIndexes()
         if selected:
-            idx = selected[0]
-            user = self.friendsModel.data(idx)
-            self.start_privmsg(self.friendsUsers[user])
+            return self.channel_at(selected[0])
+
+    def privmsg_pester(self):
+        """Opens selected user in tree when PESTER! button pressed, same as double click"""
+        channel = self.selected_channel()
+        if channel is not None:
+            self.start_privmsg(channel)
             self.tabWindow.raise_()
             self.tabWindow.activateWindow()
 
     def add_selected(self):
-        selected = self.chumsTree.selectedIndexes()
-        if selected:
-            idx = selected[0]
-            user = self.friendsUsers[self.friendsModel.data(idx)]
-            if isinstance(user, (discord.User, discord.Member)):
-                ensure_future(user.send_friend_request())
+        channel = self.selected_channel()
+        if isinstance(channel, discord.DMChannel):
+            self.app.run_client(channel.recipient.send_friend_request())
 
     def block_selected(self):
-        selected = self.chumsTree.selectedIndexes()
-        if selected:
-            idx = selected[0]
-            user = self.friendsUsers[self.friendsModel.data(idx)]
-            if isinstance(user, (discord.User, discord.Member)):
-                ensure_future(user.block())
+        channel = self.selected_channel()
+        if isinstance(channel, discord.DMChannel):
+            self.app.run_client(channel.recipient.block())
 
     def start_privmsg(self, channel):
         """
@@ -230,13 +241,15 @@ class Gui(QMainWindow):
             return self.tabWindow.add_user(channel)
 
     async def start_pm(self, user):
-        channel = await user.create_dm()
+        channel = await self.app.run_client(user.create_dm())
         self.start_privmsg(channel)
 
     @pyqtSlot(QModelIndex)
     def open_privmsg(self, index):
-        user = self.friendsModel.data(index)
-        self.start_privmsg(self.friendsUsers[user])
+        channel = self.channel_at(index)
+        if channel is None:
+            return
+        self.start_privmsg(channel)
         self.tabWindow.raise_()
         self.tabWindow.activateWindow()
 
@@ -256,7 +269,10 @@ class Gui(QMainWindow):
         self.optionsWindow = OptionsWindow(self.app, self)
 
     def openDebug(self):
-        self.debugWindow = InteractiveConsole(self.app)
+        self.debugWindow = DebugWindow(self.app)
+
+    def openShards(self):
+        self.shardsWindow = ShardStatsWindow(self.app)
 
     def toggleHide(self):
         if self.isHidden():
@@ -264,15 +280,15 @@ class Gui(QMainWindow):
             self.toggleHidden.setIcon(QIcon())
         else:
             self.hide()
-            self.toggleHidden.setIcon(QIcon(self.theme["path"] + "/x.png"))
+            self.toggleHidden.setIcon(self.app.assets.icon("x.png"))
 
     def toggleIdle(self):
         self.app.idle = not self.app.idle
         if self.app.idle:
-            ensure_future(self.app.client.change_presence(status=discord.Status.idle))
-            self.toggleIdled.setIcon(QIcon(self.theme["path"] + "/x.png"))
+            self.app.run_client(self.app.client.change_presence(status=discord.Status.idle))
+            self.toggleIdled.setIcon(self.app.assets.icon("x.png"))
         else:
-            ensure_future(self.app.client.change_presence(status=discord.Status.online))
+            self.app.run_client(self.app.client.change_presence(status=discord.Status.online))
             self.toggleIdled.setIcon(QIcon())
 
     def make_setMood(self, button):
@@ -285,7 +301,7 @@ class Gui(QMainWindow):
             for num, moodButton in self.mood_buttons.items():
                 if button == moodButton:
                     mood_name = self.app.moods.getName(num)
-                    self.nameButton.setIcon(QIcon(os.path.join(self.theme["path"], mood_name + ".png")))
+                    self.nameButton.setIcon(self.app.assets.icon(mood_name + ".png"))
                     self.app.change_mood(mood_name)
                 else:
                     moodButton.setChecked(False)
@@ -301,23 +317,3 @@ class Gui(QMainWindow):
                 print(e)
         else:
             event.accept()
-
-    class FriendsModel(QStandardItemModel):
-        def __init__(self, app, parent=None):
-            QStandardItemModel.__init__(self, parent)
-            self.app = app
-            itms = len(self.app.gui.friendsItems.keys())
-            self.header_labels = ["Chums ({}/{})".format(itms, itms)]
-
-        def headerData(self, section, orientation, role=Qt.DisplayRole):
-            fmt = "Chums ({}/{})"
-            itms = len(self.app.gui.friendsItems.keys())
-            self.header_labels = [fmt.format(itms, itms)]
-            if role == Qt.DisplayRole and orientation == Qt.Horizontal:
-                return self.header_labels[section]
-            return QStandardItemModel.headerData(self, section, orientation, role)
-
-        def update(self):
-            itms = len(self.app.gui.friendsItems.keys())
-            self.setHeaderData(0, Qt.Orientation(1),
-                               QVariant("Chums ({}/{})".format(itms, itms)))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""
+End to end load test: a `FakeDiscord` server process streams messages
+into a real, headless client, which is timed from the moment a message
+leaves the server until it is inserted in its chat window
+
+    python loadtest.py [--rates 10 100 1000] [--duration 10] [--replay events.jsonl.gz]
+
+Record a session to replay with `pesterchum.py record=events.jsonl.gz`
+"""
+
+import multiprocessing
+import subprocess
+import tempfile
+import argparse
+import socket
+import json
+import time
+import sys
+import os
+import re
+
+stamp_pattern = re.compile(r"\[lt:(\d+\.\d+)\]")
+frame = 1 / 60
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Fake Discord didn't start on port {}".format(port))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run_client(args):
+    """Run one rate against a fresh client, in its own process since Qt allows one QApplication"""
+    os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # Themes and resources are relative
+    os.environ["PESTERCHUM_CONFIG_DIR"] = tempfile.mkdtemp()
+
+    from replay import run_server, FakeDiscord
+    port = free_port()
+    server = multiprocessing.get_context("spawn").Process(
+        target=run_server, args=(port,), daemon=True,
+        kwargs=dict(rate=args.rate, duration=args.duration, recording=args.replay, speed=args.speed))
+    server.start()
+    wait_for_port(port)
+
+    import discord
+    discord.http.Route.BASE = "http://127.0.0.1:{}/api/v7".format(port)
+    from PyQt5.QtCore import QTimer
+    from auth import AuthStore
+    from dialogs import ChatDisplay
+    from pesterchum import App
+
+    latencies = list()
+    display_text = ChatDisplay.display_text
+
+    def timed_display_text(self, msg):
+        display_text(self, msg)
+        now = time.time()
+        latencies.extend(now - float(sent) for sent in stamp_pattern.findall(msg))
+
+    ChatDisplay.display_text = timed_display_text
+    AuthStore().set("loadtest", True)
+    app = App()
+
+    # A 60 FPS timer, every frame it fires late is a frame the UI couldn't draw
+    frames = dict(last=time.monotonic(), dropped=0)
+
+    def tick():
+        now = time.monotonic()
+        frames["dropped"] += max(0, int((now - frames["last"]) / frame) - 1)
+        frames["last"] = now
+
+    timer = QTimer()
+    timer.timeout.connect(tick)
+    timer.start(int(frame * 1000))
+
+    expected = int(args.rate * args.duration) if args.rate and not args.replay else None
+    run_for = FakeDiscord.warmup + args.duration + 10
+    app.loop.call_later(run_for, app.loop.stop)
+    app.loop.run_forever()
+    server.terminate()
+
+    results = dict(rate=args.rate, expected=expected, received=len(latencies),
+                   dropped_frames=frames["dropped"],
+                   p50=percentile(latencies, 50), p90=percentile(latencies, 90),
+                   p99=percentile(latencies, 99), max=max(latencies) if latencies else None)
+    with open(args.out, 'w') as rf:
+        json.dump(results, rf)
+    os._exit(0)
+
+
+def ms(value):
+    return "-" if value is None else "{:.1f}".format(value * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end message load test against a fake Discord")
+    parser.add_argument("--rates", type=float, nargs="+", default=[10, 100, 1000], help="messages per second, 0 replays at the recorded timing")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of traffic per rate")
+    parser.add_argument("--replay", help="a recording to replay instead of synthetic messages")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed when no rate is given")
+    parser.add_argument("--rate", type=float, help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.out:
+        return run_client(args)
+
+    print("{:>8}{:>12}{:>10}{:>10}{:>10}{:>10}{:>16}".format(
+        "msg/s", "received", "p50 ms", "p90 ms", "p99 ms", "max ms", "dropped frames"))
+    for rate in args.rates:
+        out = tempfile.mktemp(suffix=".json")
+        command = [sys.executable, __file__, "--rate", str(rate), "--duration", str(args.duration),
+                   "--speed", str(args.speed), "--out", out]
+        if args.replay:
+            command += ["--replay", args.replay]
+        subprocess.run(command, stdout=subprocess.DEVNULL)
+        try:
+            with open(out, 'r') as rf:
+                r = json.load(rf)
+        except (OSError, ValueError):
+            print("{:>8g}  client failed".format(rate))
+            continue
+        received = str(r["received"]) if r["expected"] is None else "{}/{}".format(r["received"], r["expected"])
+        print("{:>8g}{:>12}{:>10}{:>10}{:>10}{:>10}{:>16}".format(
+            rate, received, ms(r["p50"]), ms(r["p90"]), ms(r["p99"]), ms(r["max"]), r["dropped_frames"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+class MemberDirectory(object):
+    """
+    Index of every cached `discord.Member` by user id, so mention clicks and
+    context menu actions don't have to scan every member of every guild.
+    Kept current from the client's member events
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.members = dict()  # user id -> {guild id: Member}
+
+    def rebuild(self, members):
+        """Index `members` of every guild, listed on the client's thread"""
+        self.members.clear()
+        for member in members:
+            self.add(member)
+
+    def add_guild(self, guild, members):
+        for member in members:
+            self.add(member)
+
+    def remove_guild(self, guild):
+        for guilds in list(self.members.values()):
+            member = guilds.get(guild.id)
+            if member is not None:
+                self.remove(member)
+
+    def add(self, member):
+        self.members.setdefault(member.id, dict())[member.guild.id] = member
+
+    def remove(self, member):
+        guilds = self.members.get(member.id)
+        if guilds is not None:
+            guilds.pop(member.guild.id, None)
+            if not guilds:
+                del self.members[member.id]
+
+    def update(self, before, after):
+        self.add(after)
+
+    def get(self, id):
+        """Get a `Member` (from any guild) or `User` by id"""
+        guilds = self.members.get(id)
+        if guilds:
+            return next(iter(guilds.values()))
+        return self.client.get_user(id)
@@ -18,19 +18,34 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
+import re
+
+# <@id> and <@!id> are users, <#id> channels and <@&id> roles, message text reaches us HTML escaped
+mention_pattern = re.compile(r"(?:<|&lt;)(@!?|#|@&)(\d+)(?:>|&gt;)")
 
 
 class Mentions(object):
     @staticmethod
     def process_mentions(text, message):
-        fin = text
-        for member in message.mentions:
-            fin = text.replace(member.mention, f'<a href="mention={member.id}">@{member.display_name}</a>')
-        for channel in message.channel_mentions:
-            fin = text.replace(channel.mention, f'<a href="channel={channel.id}">#{channel.name}</a>')
-        for role in message.role_mentions:
-            fin = text.replace(role.mention, f'<a href="role={role.id}" style="color: {role.color}">@{role.name}</a>')
-        return fin
+        """Replace every mention in `text` with a link, in one pass over the text"""
+        if not (message.mentions or message.channel_mentions or message.role_mentions):
+            return text
+        members = {str(member.id): member for member in message.mentions}
+        channels = {str(channel.id): channel for channel in message.channel_mentions}
+        roles = {str(role.id): role for role in message.role_mentions}
+
+        def link(match):
+            kind, id = match.groups()
+            if kind == "#":
+                channel = channels.get(id)
+                return Mentions.fmt_channel(channel) if channel is not None else match.group(0)
+            if kind == "@&":
+                role = roles.get(id)
+                return Mentions.fmt_role(role) if role is not None else match.group(0)
+            member = members.get(id)
+            return Mentions.fmt_mention(member) if member is not None else match.group(0)
+
+        return mention_pattern.sub(link, text)
 
     @staticmethod
     def fmt_mention(member):
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from contextlib import contextmanager
+from bisect import bisect_left
+import json
+import time
+
+# Histogram bucket upper bounds in seconds, from 100µs to 10s
+bounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+          0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return dict(count=self.value)
+
+
+class Histogram(object):
+    """
+    A latency histogram with fixed buckets, constant time and memory per
+    observation however long the client runs
+    """
+
+    def __init__(self):
+        self.buckets = [0] * len(bounds)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the `p`th percentile"""
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100
+        seen = 0
+        for bound, n in zip(bounds, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return dict(count=self.count, mean=self.mean, p50=self.percentile(50),
+                    p90=self.percentile(90), p99=self.percentile(99), max=self.max)
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms for the client's hot paths, shown live
+    in the debug window's metrics tab and exportable to JSON
+    """
+
+    def __init__(self):
+        self.counters = dict()
+        self.histograms = dict()
+        self.started = time.time()
+
+    def counter(self, name):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = Counter()
+        return counter
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def inc(self, name, n=1):
+        self.counter(name).inc(n)
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    @contextmanager
+    def time(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def probe_loop(self, loop, interval=0.5):
+        """Observe how late the event loop runs a callback scheduled every `interval` seconds as loop.lag"""
+        expected = time.perf_counter() + interval
+
+        def probe():
+            nonlocal expected
+            now = time.perf_counter()
+            self.observe("loop.lag", max(0.0, now - expected))
+            expected = now + interval
+            loop.call_later(interval, probe)
+
+        loop.call_later(interval, probe)
+
+    def snapshot(self):
+        metrics = {name: counter.snapshot() for name, counter in self.counters.items()}
+        metrics.update((name, histogram.snapshot()) for name, histogram in self.histograms.items())
+        return metrics
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump(dict(started=self.started, exported=time.time(), metrics=self.snapshot()), f, indent=4)
@@ -25,6 +25,7 @@ class Moods(object):
              "devious", "sleek", "detestful", "mirthful", "manipulative",
              "vigorous", "perky", "acceptant", "protective", "mystified",
              "amazed", "insolent", "bemused"]
+    indexes = {name: index for index, name in enumerate(moods)}
 
     def __init__(self):
         self.usermoods = dict()
@@ -33,9 +34,24 @@ class Moods(object):
     @staticmethod
     def getMood(name):
         name = "offline" if name.lower() == "abscond" else name
-        return Moods.moods.index(name.lower())
+        return Moods.indexes[name.lower()]
 
     @staticmethod
     def getName(index):
         return Moods.moods[index]
 
+    @staticmethod
+    def from_presence(status, activities):
+        """
+        Get the mood name of a presence. Moods are set as a "Feeling MOOD"
+        activity by `App.change_mood`, anyone online without one is chummy
+        """
+        if str(status) in ("offline", "invisible"):
+            return "offline"
+        for activity in activities:
+            name = getattr(activity, "name", None) or ""
+            if name.startswith("Feeling "):
+                mood = name[8:].strip().lower()
+                if mood in Moods.indexes:
+                    return mood
+        return "chummy"
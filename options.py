@@ -19,9 +19,10 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
-import json
 import os
 
+from config import ConfigFile, cfgdir
+
 default_options = {
     "chum_list":{
         "hide_offline_chums":False,
@@ -37,6 +38,8 @@ default_options = {
         "op_and_voice_in_memos":False,
         "use_animated_smilies":False,
         "receive_random_encounters":False,
+        "buffer_size":100,
+        "message_cache":1000,
         },
     "interface":{
         "tabbed_conversations":True,
@@ -49,37 +52,59 @@ default_options = {
         },
     "theme":{
         "theme":"pesterchum2.5"
+        },
+    "cluster":{
+        "workers":0
+        },
+    "debug":{
+        "stall_threshold":250
         }
     }
 
-if not os.path.exists("cfg"):
-    os.mkdir("cfg")
-if not os.path.exists("cfg/options.json"):
-    with open("cfg/options.json", 'w+') as options:
-        options.write(json.dumps(default_options, indent=4))
-confpath = "cfg/options.json"
-if os.path.exists(confpath):
-    with open(confpath, 'r') as options:
-        data = options.read()
-    Options = json.loads(data)
-    opt_keys = Options.keys()
-    for key in default_options.keys():
-        if key not in opt_keys:
-            Options[key] = default_options[key]
-        else:
-            opt_keys_2 = Options[key].keys()
-            for key in default_options[key].keys():
-                if key not in opt_keys_2:
-                    Options[key][key] = default_options[key][key]
-else:
-    with open(confpath, 'w') as options:
-        options.write(json.dumps(default_options, indent=4))
+confpath = os.path.join(cfgdir, "options.json")
+
+
+class OptionsStore(ConfigFile):
+    """
+    The client options, `default_options` doubles as their schema. Sections
+    read like dicts, changes go through `set` so listeners added with
+    `connect` hear about exactly the options that changed
+    """
+
+    def __init__(self, path=confpath):
+        self.listeners = list()
+        super(__class__, self).__init__(path, default_options)
+
+    def validate(self, data):
+        """Fill in missing sections and options, and reset options of the wrong type"""
+        if not isinstance(data, dict):
+            data = dict()
+        for section, defaults in default_options.items():
+            values = data.get(section)
+            if not isinstance(values, dict):
+                values = data[section] = dict()
+            for key, default in defaults.items():
+                if type(values.get(key)) is not type(default):
+                    values[key] = default
+        return data
 
-    with open(confpath, 'r') as options:
-        data = options.read()
-    Options = json.loads(data)
+    def __getitem__(self, section):
+        return self.data[section]
 
+    def set(self, section, key, value):
+        """Change an option, returns whether it changed"""
+        default = default_options[section][key]
+        if type(value) is not type(default):
+            raise TypeError("{}.{} must be {}, not {}".format(
+                section, key, type(default).__name__, type(value).__name__))
+        if self.data[section][key] == value:
+            return False
+        self.data[section][key] = value
+        self.changed()
+        for listener in self.listeners:
+            listener(section, key, value)
+        return True
 
-def save_options(options):
-    with open("cfg/options.json", 'w') as conffile:    
-        conffile.write(json.dumps(options, indent=4))
+    def connect(self, listener):
+        """Call `listener(section, key, value)` whenever an option changes"""
+        self.listeners.append(listener)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from collections import deque
+from datetime import datetime
+from itertools import count
+import asyncio
+import time
+
+import aiohttp
+import discord
+
+from formatting import fmt_send_error
+
+
+def split_message(text, limit=2000):
+    """Split `text` into chunks of at most `limit` characters, preferring line and word breaks"""
+    chunks = list()
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            chunks.append(text[:limit])
+            text = text[limit:]
+        else:
+            chunks.append(text[:cut])
+            text = text[cut + 1:]
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+class RateLimiter(object):
+    """Sliding window rate limit of `rate` calls every `per` seconds"""
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.calls = deque()
+
+    async def acquire(self):
+        now = time.monotonic()
+        while self.calls and now - self.calls[0] >= self.per:
+            self.calls.popleft()
+        if len(self.calls) >= self.rate:
+            await asyncio.sleep(self.per - (now - self.calls[0]))
+            self.calls.popleft()
+        self.calls.append(time.monotonic())
+
+
+class Outgoing(object):
+    """
+    A message waiting in the `Outbox`. It also stands in for the
+    `discord.Message` when formatting its local echo
+    """
+
+    def __init__(self, channel, author, content, tts, widget, nonce):
+        self.channel = channel
+        self.guild = getattr(channel, "guild", None)
+        self.author = author
+        self.content = content
+        self.tts = tts
+        self.widget = widget
+        self.nonce = nonce
+        self.html = ""
+        self.created_at = datetime.utcnow()
+        self.queued = time.monotonic()
+        self.mentions = self.channel_mentions = self.role_mentions = ()
+
+
+class Outbox(object):
+    """
+    Ordered per-channel outbound message queues. Each channel has at most one
+    sender task, so messages arrive in the order they were sent. Sends wait
+    on Discord's per-channel limit of 5 messages every 5 seconds before
+    hitting a 429. Only sends that surely didn't arrive are retried, with
+    exponential backoff: 429s, and connections that never opened. Each message is echoed locally as soon as
+    it is queued, and the echo is replaced by the real message when the REST
+    response or the gateway event arrives, whichever is first
+    """
+    max_length = 2000
+    retries = 5
+    max_backoff = 30
+
+    def __init__(self, app):
+        self.app = app
+        self.queues = dict()  # channel id -> deque of Outgoing
+        self.senders = dict()  # channel id -> Task
+        self.limiters = dict()  # channel id -> RateLimiter
+        self.pending = dict()  # nonce -> Outgoing
+        self.seen = set()  # ids of acknowledged messages
+        self.seenOrder = deque()
+        self.nonces = count()
+
+    def next_nonce(self):
+        return str(discord.utils.time_snowflake(datetime.utcnow()) + next(self.nonces) % 4096)
+
+    def send(self, channel, content, tts=False, widget=None, author=None):
+        """Queue `content` for `channel`, split into messages of at most 2000 characters"""
+        if author is None:
+            author = getattr(channel, "guild", None) and channel.guild.me or self.app.client.user
+        for chunk in split_message(content, self.max_length):
+            outgoing = Outgoing(channel, author, chunk, tts, widget, self.next_nonce())
+            self.pending[outgoing.nonce] = outgoing
+            if widget is not None:
+                outgoing.html = self.app.format_message(outgoing)
+                widget.display_echo(outgoing.nonce, outgoing.html)
+            self.queues.setdefault(channel.id, deque()).append(outgoing)
+        if channel.id not in self.senders:
+            self.senders[channel.id] = asyncio.ensure_future(self.drain(channel.id))
+
+    async def drain(self, channel_id):
+        queue = self.queues[channel_id]
+        try:
+            while queue:
+                await self.deliver(queue[0])
+                queue.popleft()
+        finally:
+            del self.senders[channel_id]
+            if not queue:
+                self.queues.pop(channel_id, None)
+
+    async def deliver(self, outgoing):
+        limiter = self.limiters.get(outgoing.channel.id)
+        if limiter is None:
+            limiter = self.limiters[outgoing.channel.id] = RateLimiter(5, 5)
+        backoff = 1
+        for attempt in range(self.retries + 1):
+            await limiter.acquire()
+            try:
+                message = await self.app.run_client(
+                    outgoing.channel.send(outgoing.content, tts=outgoing.tts, nonce=outgoing.nonce))
+            except discord.HTTPException as e:
+                # discord.py has already retried 429s and server errors. A 429 was refused and
+                # is safe to send again, a server error may have posted the message anyway
+                if e.status != 429 or attempt == self.retries:
+                    return self.fail(outgoing, e, maybe_sent=e.status >= 500)
+            except aiohttp.ClientConnectorError as e:
+                # Never connected, nothing was sent
+                if attempt == self.retries:
+                    return self.fail(outgoing, e)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # The request may have reached Discord, which doesn't dedupe by nonce
+                return self.fail(outgoing, e, maybe_sent=True)
+            else:
+                if not self.is_acknowledged(message):
+                    # The gateway copy will be dropped as already seen, so buffer this one
+                    self.app.buffers.append(message)
+                    if self.acknowledge(message) is not None:
+                        self.app.display_sent(outgoing, message)
+                return
+            self.app.metrics.inc("send.retries")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def fail(self, outgoing, error, maybe_sent=False):
+        """
+        Mark `outgoing` as failed. When it `maybe_sent`, it stays pending, so
+        its gateway event still replaces the failure notice if it arrives
+        """
+        self.app.metrics.inc("send.failed")
+        if not maybe_sent:
+            self.pending.pop(outgoing.nonce, None)
+        if outgoing.widget is not None:
+            try:
+                outgoing.widget.reconcile_echo(outgoing.nonce, fmt_send_error(outgoing.html, error, maybe_sent),
+                                               pending=maybe_sent)
+            except RuntimeError:
+                pass  # The widget was closed
+
+    def is_acknowledged(self, message):
+        return message.id in self.seen
+
+    def acknowledge(self, message):
+        """
+        Mark one of our messages as delivered, returns its `Outgoing` the first
+        time it is seen with a nonce we sent, otherwise None
+        """
+        if message.id in self.seen:
+            return None
+        self.seen.add(message.id)
+        self.seenOrder.append(message.id)
+        if len(self.seenOrder) > 1024:
+            self.seen.discard(self.seenOrder.popleft())
+        outgoing = self.pending.pop(str(message.nonce), None)
+        if outgoing is not None:
+            self.app.metrics.observe("send.ack", time.monotonic() - outgoing.queued)
+        return outgoing
@@ -19,78 +19,145 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import multiprocessing
 import subprocess
+import os
 import sys
 
-import requests
 import simpleaudio as sa
 
-from options import Options
-
 __version__ = "v1.3.5"
 __author__ = "henry232323"
 
-if Options["interface"]["auto_update"]:
-    response = requests.get("https://api.github.com/repos/henry232323/pesterchum-discord/releases/latest").json()
-    current_version = response["tag_name"]
-    if current_version > __version__:
-        sa.WaveObject.from_wave_file("resources/update.wav").play()
-        download_url = response["assets"][0]["browser_download_url"]
-        subprocess.call("start updater.exe {}".format(download_url), shell=True)
-        sys.exit()
+if __name__ == "__main__":
+    # Frozen builds start cluster workers by re-running this script, hand them off first
+    multiprocessing.freeze_support()
+
+    # An update downloaded last session is installed before anything else loads
+    import updater
+    try:
+        if os.environ.pop("PESTERCHUM_UPDATED", None):
+            # Restarted after an update, what the old process still held can go now
+            updater.remove_old()
+        if updater.apply_staged():
+            updater.remove_old()
+            if getattr(sys, "frozen", False):
+                # Frozen builds are their own executable, there is no script to pass
+                command = [sys.executable] + sys.argv[1:]
+            else:
+                command = [sys.executable] + sys.argv
+            subprocess.Popen(command, env=dict(os.environ, PESTERCHUM_UPDATED="1"))
+            sys.exit()
+    except OSError as e:
+        print("Couldn't install update: {}".format(e))
 
 from quamash import QEventLoop, QThreadExecutor
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtGui import QColor
 import discord
-import aiohttp
 
 from inspect import isawaitable
 import asyncio
 import os.path
+import time
 
 from dialogs import AuthDialog, ConnectingDialog
 from client import DiscordClient, AutoShardClient
 from theme import themes, getThemes
-from auth import UserAuth, save_auth
-from formatting import fmt_disp_msg
-from options import save_options
+from assets import ThemeAssets
+from auth import AuthStore
+from formatting import fmt_disp_msg, FormatContext
+from options import OptionsStore
 from mentions import Mentions
 from emojis import Emojis
 from quirks import Quirks
 from moods import Moods
+from members import MemberDirectory
+from roster import MemberListModel, ChumsModel, ChumsProxyModel
+from bandwidth import BandwidthMeter
+from metrics import Metrics
+from bus import ClientThread, EventBus
+from watchdog import StallWatchdog
+from cluster import Cluster
+from outbox import Outbox
+from routing import Router
+from buffers import ChannelBuffers
+from records import RecordTables
+from prefetch import Prefetcher
+from web import HttpClient
+from replay import EventRecorder
+from updater import release_asset, asset_sha256, stage_update
 from gui import Gui
 
 
 class App(QApplication):
+    shutdown_timeout = 5  # Seconds to wait for the client to disconnect on exit
+
     def __init__(self):
         QApplication.__init__(self, sys.argv)
         # Establish loop as Quamash Event Loop
         self.loop = loop = QEventLoop(self)
         asyncio.set_event_loop(loop)
-        self.session = None
+        self.started = False
+        self.exitCode = None
 
         self.idle = False
         self.trayIcon = None
         self.connectingDialog = None
 
         self.themes = themes
-        self.options = Options
+        self.options = OptionsStore()
+        self.options.connect(self.on_option_changed)
         try:
             self.theme = themes[self.options["theme"]["theme"]]
         except KeyError:
             self.theme = themes["Pesterchum 2.5"]
         self.theme_name = self.theme["name"]
+        self.assets = ThemeAssets(self.theme)
         self.moods = Moods
         self.emojis = Emojis(self)
         self.mentions = Mentions
         self.setStyleSheet(self.theme["styles"])
 
         self.nick = None
-        self.token, self.botAccount = UserAuth
-        self.client = (
-            lambda app, loop: AutoShardClient(app=app, loop=loop, shard_id=3) if self.botAccount else DiscordClient(
-                app=app, loop=loop))(app=self, loop=self.loop)
+        self.auth = AuthStore()
+        self.token, self.botAccount = self.auth.data
+        self.metrics = Metrics()
+        self.metrics.probe_loop(self.loop)
+        # Reports where the loop blocks for longer than stall_threshold ms, 0 turns it off
+        self.watchdog = None
+        if self.options["debug"]["stall_threshold"] > 0:
+            self.watchdog = StallWatchdog(self.loop, threshold=self.options["debug"]["stall_threshold"] / 1000,
+                                          metrics=self.metrics)
+            self.watchdog.start()
+        self.bandwidth = BandwidthMeter(self.loop)
+        # record=<path> captures gateway events for replay with loadtest.py
+        self.recorder = None
+        for arg in sys.argv:
+            if arg.startswith("record="):
+                self.recorder = EventRecorder(arg[7:])
+        self.http = HttpClient(self.loop, bandwidth=self.bandwidth, metrics=self.metrics)
+        # Bot accounts can spread their shards over worker processes
+        self.cluster = None
+        if self.botAccount and self.options["cluster"]["workers"]:
+            self.cluster = Cluster(self, self.options["cluster"]["workers"])
+        # The client runs on its own loop thread, its events reach the GUI through the bus
+        self.bus = EventBus(self.loop, metrics=self.metrics)
+        self.clientThread = ClientThread()
+        self.clientThread.start()
+        self.client = self.clientThread.run_sync(self.make_client)
+        self.members = MemberDirectory(self.client)
+        self.outbox = Outbox(self)
+        self.formatter = FormatContext(self)
+        self.memberLists = dict()
+        self.router = Router()
+        self.records = RecordTables(self)
+        self.buffers = ChannelBuffers(self, self.options["conversations"]["buffer_size"])
+        self.prefetcher = Prefetcher(self)
+        self.chumsModel = ChumsModel(self)
+        self.chumsProxy = ChumsProxyModel(self)
+        self.chumsProxy.setSourceModel(self.chumsModel)
+        self.chumsProxy.sort(0)
         # print(self.client)
 
         self.loop.call_later(10, lambda: self.loop.create_task(self.on_ready()))
@@ -102,13 +169,89 @@ class App(QApplication):
         self.gui.initialize()
 
         self.authevent = None
+        if self.options["interface"]["auto_update"]:
+            loop.create_task(self.check_update())
         loop.create_task(self.runbot())
 
         if not self.token:
             self.authevent = asyncio.Event()
             self.openAuth(i=True)
             self.authevent.set()
-            save_auth((self.token, self.botAccount,))
+            self.auth.set(self.token, self.botAccount)
+
+    def make_client(self):
+        """Build the client, called on the client's thread so it binds to that loop"""
+        if self.botAccount:
+            return AutoShardClient(app=self, loop=self.clientThread.loop, **self.client_options())
+        return DiscordClient(app=self, loop=self.clientThread.loop, **self.client_options())
+
+    def run_client(self, coro):
+        """
+        Run a coroutine that talks to Discord on the client's loop, returns a
+        future the GUI loop can await
+        """
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.clientThread.loop), loop=self.loop)
+
+    def read_client(self, func, *args):
+        """
+        Call `func` on the client's thread and return a future of its result.
+        Lists of guilds, channels and members are taken with this: the client
+        thread updates them, the GUI thread must not iterate them itself
+        """
+        async def call():
+            return func(*args)
+        return self.run_client(call())
+
+    def on_gateway_frame(self, size):
+        self.metrics.inc("gateway.frames")
+        self.bandwidth.add(size)
+
+    def receive_message(self, message, received):
+        """Called through the bus for every message, `received` is when the client thread got it"""
+        started = time.perf_counter()
+        self.metrics.observe("bus.delivery", started - received)
+        self.on_message(message)
+        self.metrics.observe("message.handle", time.perf_counter() - started)
+
+    @property
+    def low_bandwidth(self):
+        return self.options["chum_list"]["low_bandwidth"]
+
+    @property
+    def history_limit(self):
+        """How many messages to fetch when a conversation is opened"""
+        return 25 if self.low_bandwidth else 100
+
+    def client_options(self):
+        """
+        Keyword arguments for the client. Low bandwidth mode only subscribes to
+        guild structure and messages: no presences, typing or member updates,
+        no member chunking, and a smaller message cache. The gateway is always
+        zlib-stream compressed by discord.py.
+        In cluster mode the GUI client keeps only the guilds intent: it still
+        connects every shard and parses all guild and channel state, only
+        message events are moved to the workers.
+        discord.py's own message cache, which edits and deletes are matched
+        against, is sized by conversations.message_cache
+        """
+        max_messages = self.options["conversations"]["message_cache"] or None
+        if self.cluster is not None:
+            intents = discord.Intents.none()
+            intents.guilds = True
+            return dict(intents=intents,
+                        member_cache_flags=discord.MemberCacheFlags.from_intents(intents),
+                        chunk_guilds_at_startup=False,
+                        max_messages=max_messages)
+        if not self.low_bandwidth:
+            return dict(max_messages=max_messages)
+        intents = discord.Intents.none()
+        intents.guilds = True
+        intents.guild_messages = True
+        intents.dm_messages = True
+        return dict(intents=intents,
+                    member_cache_flags=discord.MemberCacheFlags.from_intents(intents),
+                    chunk_guilds_at_startup=False,
+                    max_messages=min(max_messages, 100) if max_messages else None)
 
     def cli(self):
         """
@@ -138,56 +281,164 @@ class App(QApplication):
         # self.connectingDialog.exec_()
         print("closed connecting (one day)")
 
-    async def on_message(self, message):
+    def on_message(self, message):
         """Called on `Client.on_message`, Message handling happens here"""
 
-        if message.content.startswith("_") and message.content.endswith("_"):
-            message.content = "/me " + message.content[1:-1]
+        own = message.author.id == self.client.user.id
+        if own and self.outbox.is_acknowledged(message):
+            return
 
-        if isinstance(message.channel, (discord.DMChannel, discord.GroupChannel)):
-            if isinstance(message.channel, discord.GroupChannel):
-                if not message.channel.name:
-                    message.channel.name = ",".join(map(lambda m: m.display_name, message.channel.recipients))
-                tab = self.gui.start_privmsg(message.channel)
-            else:
-                tab = self.gui.start_privmsg(message.channel)
-            fmt = fmt_disp_msg(self, message.content, message, user=message.author)
-            if fmt:
-                tab.display_text(fmt)
-        else:
-            if self.gui.memosWindow:
-                if message.guild in self.gui.memosWindow.open.keys():
-                    fmt = fmt_disp_msg(self, message.content, message, user=message.author)
-                    if fmt:
-                        try:
-                            self.gui.memosWindow.display_message(message.channel, fmt)
-                        except AttributeError as e:
-                            print(e)
+        widget = self.router.get(message.channel.id)
+        if widget is None and isinstance(message.channel, (discord.DMChannel, discord.GroupChannel)):
+            # A new conversation opens a tab, which adds its route
+            widget = self.gui.start_privmsg(message.channel)
+        self.buffers.append(message, unread=not own and (widget is None or not widget.isVisible()))
+
+        if own:
+            # Our own message, its local echo may already be displayed
+            outgoing = self.outbox.acknowledge(message)
+            if outgoing is not None and outgoing.widget is not None:
+                self.display_sent(outgoing, message)
+                return
+
+        if widget is not None:
+            widget.display_message(message)
+
+    def on_message_edit(self, before, after):
+        self.buffers.replace(after)
+        widget = self.router.get(after.channel.id)
+        if widget is not None:
+            widget.update_message(after)
+
+    def on_raw_message_delete(self, payload):
+        self.buffers.remove(payload.channel_id, payload.message_id)
+        widget = self.router.get(payload.channel_id)
+        if widget is not None:
+            widget.remove_message(payload.message_id)
+
+    def format_message(self, message):
+        """Format a `discord.Message`, or an `Outgoing` local echo, for display"""
+        content = message.content
+        if content.startswith("_") and content.endswith("_"):
+            content = "/me " + content[1:-1]
+        with self.metrics.time("message.format"):
+            return fmt_disp_msg(self, content, message, user=message.author)
+
+    def display_sent(self, outgoing, message):
+        """Replace the local echo of `outgoing` with the message Discord acknowledged"""
+        try:
+            outgoing.widget.reconcile_echo(outgoing.nonce, self.format_message(message), message)
+        except RuntimeError:
+            pass  # The widget was closed
+
+    def on_private_channel_create(self, channel):
+        self.chumsModel.add_channel(channel)
+
+    def on_private_channel_delete(self, channel):
+        self.chumsModel.remove_channel(channel)
+        self.buffers.drop(channel.id)
+
+    def on_guild_remove(self, guild):
+        self.members.remove_guild(guild)
+        self.buffers.drop_guild(guild)
+
+    def on_unread(self, channel):
+        """Called by `ChannelBuffers` when the unread counters of `channel` change"""
+        if isinstance(channel, (discord.DMChannel, discord.GroupChannel)):
+            self.chumsModel.update_unread(channel.id)
+        elif self.gui.memosWindow is not None:
+            self.gui.memosWindow.update_unread(channel.guild)
+
+    def on_private_channel_update(self, channel):
+        self.chumsModel.update_channel(channel)
+
+    def on_user_update(self, before, after):
+        self.formatter.invalidate(after)
+        self.records.update_author(after)
+        self.chumsModel.update_user(after)
+
+    def on_member_join(self, member):
+        self.members.add(member)
+        memberList = self.memberLists.get(member.guild.id)
+        if memberList is not None:
+            memberList.update(member)
+
+    def on_member_remove(self, member):
+        self.members.remove(member)
+        memberList = self.memberLists.get(member.guild.id)
+        if memberList is not None:
+            memberList.remove(member.id)
+
+    def on_member_update(self, before, after):
+        self.members.update(before, after)
+        if before.display_name != after.display_name or before.roles != after.roles:
+            self.formatter.invalidate(after)
+            self.records.update_author(after)
+        memberList = self.memberLists.get(after.guild.id)
+        if memberList is not None:
+            memberList.update(after)
+        if before.status != after.status or before.activities != after.activities:
+            self.chumsModel.update_presence(after)
+
+    def get_member_list(self, guild):
+        """Get the shared `MemberListModel` of a guild, creating it on first use"""
+        memberList = self.memberLists.get(guild.id)
+        if memberList is None:
+            memberList = self.memberLists[guild.id] = MemberListModel(self, guild)
+        return memberList
 
     async def on_ready(self):
         """Called on `Client.on_ready`, generally once the client is logged in and ready"""
         # print("on ready!!!")
-        if self.session is None:
-            self.session = aiohttp.ClientSession(loop=self.loop)
+        if not self.started:
+            self.started = True
             try:
                 # print("received ready")
                 # self.connectingDialog.close()
                 # self.connectingDialog = None
                 self.nick = self.client.user.name
+                self.chumsModel.rebuild(self.client.private_channels)
                 self.quirks = Quirks(self)
                 if "debug" in sys.argv:
                     self.cli()
                 sa.WaveObject.from_wave_file(os.path.join(self.theme["path"], "alarm.wav")).play()
+                self.prefetcher.start()
             except Exception as e:
                 self.gui.nameButton.setText(str(e))
             finally:
                 self.gui.initialize()
+        else:
+            # A new session, not a resume: whatever was sent while disconnected is missing
+            self.buffers.mark_gaps()
+
+    async def check_update(self):
+        """
+        Check GitHub for a newer release and download it in the background,
+        it is installed on the next launch
+        """
+        try:
+            response = await self.http.get_json(
+                "https://api.github.com/repos/henry232323/pesterchum-discord/releases/latest")
+            current_version = response["tag_name"]
+            if current_version > __version__:
+                # Only changed files are fetched when the release has a manifest
+                asset = release_asset(response)
+                await stage_update(self.http, asset["browser_download_url"],
+                                   version=current_version, sha256=asset_sha256(asset))
+                sa.WaveObject.from_wave_file("resources/update.wav").play()
+                print("Update {} downloaded, it will be installed on next launch".format(current_version))
+        except Exception as e:
+            print("Update failed: {}".format(e))
+
+    def on_cluster_stats(self):
+        if self.gui.shardsWindow is not None:
+            self.gui.shardsWindow.refresh()
 
     def change_mood(self, mood):
         if mood in ("offline", "abscond"):
-            asyncio.ensure_future(self.client.change_presence(status=discord.Status.invisible))
+            self.run_client(self.client.change_presence(status=discord.Status.invisible))
         else:
-            asyncio.ensure_future(
+            self.run_client(
                 self.client.change_presence(activity=discord.Game(name="Feeling {}".format(mood.upper())),
                                             status=discord.Status.online))
 
@@ -201,11 +452,25 @@ class App(QApplication):
             self.theme = themes[theme]
             self.theme_name = self.theme["name"]
             self.setStyleSheet(self.theme["styles"])
+            self.assets = ThemeAssets(self.theme)
+            self.chumsModel.refresh_icons()
+            self.formatter.refresh()
             if hasattr(self, "gui"):
                 self.gui.close()
                 self.gui = Gui(self.loop, self)
                 self.gui.initialize()
 
+    def on_option_changed(self, section, key, value):
+        """Called by `OptionsStore.set`, apply only the option that changed"""
+        if section == "chum_list":
+            self.chumsProxy.refresh()
+        elif section == "theme":
+            self.change_theme(value)
+        elif key == "buffer_size":
+            self.buffers.resize(value)
+        elif key == "stall_threshold" and self.watchdog is not None:
+            self.watchdog.threshold = value / 1000
+
     def refresh_themes(self):
         self.themes = getThemes(dict())
 
@@ -221,8 +486,11 @@ class App(QApplication):
         elif type is QColor:
             return QColor(clr.r, clr.g, clr.b)
 
-    def send_msg(self, message, channel):
-        """Send message `message` to the User, Private Channel, or Channel `channel`"""
+    def send_msg(self, message, channel, widget=None):
+        """
+        Queue message `message` for the User, Private Channel, or Channel `channel`
+        in the `Outbox`, echoing it in `widget` until it is sent
+        """
         message = message.strip()
         tts = False
         if message.startswith("/me"):
@@ -233,7 +501,7 @@ class App(QApplication):
         if message.startswith("/ooc"):
             message = "((" + message[4:] + "))"
         message = self.quirks.process_quirks(message)
-        asyncio.ensure_future(channel.send(message, tts=tts))
+        self.outbox.send(channel, message, tts=tts, widget=widget)
 
     def openAuth(self, f=False, i=True):
         auth = AuthDialog(self, self.gui, f=f, i=i).auth
@@ -247,32 +515,60 @@ class App(QApplication):
         if self.authevent is not None:
             await self.authevent.wait()
         try:
-            await self.client.start(self.token, bot=self.botAccount)
+            if self.cluster is not None and not self.cluster.processes:
+                await self.cluster.start(self.token)
+            await self.run_client(self.client.start(self.token, bot=self.botAccount))
         except discord.LoginFailure:
             self.authevent = asyncio.Event()
             self.openAuth(f=True)
             self.authevent.set()
-            save_auth((self.token, self.botAccount,))
+            self.auth.set(self.token, self.botAccount)
             await asyncio.sleep(x)
             await self.runbot(x * 2)
 
     def exit(self, code=0):
         """
         Called when exiting the client
-        Save configurations and sys.exit
+        Save configurations, then close connections and stop the loops,
+        the process exits once `run_forever` returns
         """
+        if self.exitCode is not None:
+            return
+        self.exitCode = code
         try:
-            save_auth((self.token, self.botAccount,))
-            save_options(self.options)
+            if self.cluster is not None:
+                self.cluster.stop()
+            if self.recorder is not None:
+                self.recorder.close()
+            if self.watchdog is not None:
+                self.watchdog.stop()
+            self.prefetcher.stop()
+            self.auth.set(self.token, self.botAccount)
+            self.options.save()
             self.quirks.save_quirks()
         except:
             pass
+        if not self.loop.is_running():
+            sys.exit(code)  # Still starting up, nothing is connected yet
+        self.loop.create_task(self.shutdown())
+
+    async def shutdown(self):
+        """Close the pooled HTTP session and the Discord client, then stop both loops"""
+        try:
+            await self.http.close()
+            await asyncio.wait_for(self.run_client(self.client.close()), self.shutdown_timeout)
+        except Exception as e:
+            print("Unclean shutdown: {}".format(e))
         finally:
-            sys.exit(code)
+            self.clientThread.stop()
+            self.loop.stop()
 
     def lastWindowClosed(self):
         self.exit()
 
 
-app = App()
-app.loop.run_forever()
+if __name__ == "__main__":
+    app = App()
+    app.loop.run_forever()
+    app.clientThread.join(app.shutdown_timeout)
+    sys.exit(app.exitCode)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from collections import deque
+import asyncio
+import time
+
+import discord
+
+
+class Prefetcher(object):
+    """
+    Warms the channel buffers with the history of conversations likely to
+    be opened next, so their tabs draw from the buffer instead of waiting
+    on a history request. At most `concurrency` fetches run at once, and
+    at most `budget` are started every `window` seconds
+    """
+    top = 10  # Most recently active DMs and channels warmed after startup
+    concurrency = 2
+    budget = 30
+    window = 300
+    idle_lag = 0.02  # A loop is idle when a short sleep oversleeps by less than this
+
+    def __init__(self, app):
+        self.app = app
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.tasks = dict()  # channel id -> prefetch task
+        self.running = set()  # channel ids holding a fetch slot
+        self.hinted = set()  # channel ids queued from the chum list
+        self.started = deque()  # start times of the fetches in the current window
+        self.startup = None
+
+    def candidates(self):
+        """
+        The `top` most recently active DMs and readable guild channels, most
+        recent first. Walks the client's guilds, call it on the client's thread
+        """
+        # discord.py moves a private channel to the end when it sees a message in it
+        private = list(reversed(self.app.client.private_channels))[:self.top]
+        channels = list()
+        for guild in self.app.client.guilds:
+            me = guild.me
+            channels.extend(channel for channel in guild.text_channels
+                            if channel.last_message_id and channel.permissions_for(me).read_messages)
+        channels.sort(key=lambda channel: channel.last_message_id, reverse=True)
+        return private + channels[:self.top]
+
+    def start(self):
+        """Warm the candidates in the background, one at a time whenever the loop is idle"""
+        self.startup = asyncio.ensure_future(self.warm_idle())
+
+    async def warm_idle(self):
+        for channel in await self.app.read_client(self.candidates):
+            while not await self.idle():
+                pass
+            task = self.warm(channel)
+            if task is None:
+                continue
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise  # The startup pass itself was cancelled
+
+    async def idle(self, interval=0.1):
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        return time.monotonic() - started - interval < self.idle_lag
+
+    def is_warm(self, channel):
+        buffer = self.app.buffers.buffers.get(channel.id)
+        return (buffer is not None and buffer.contiguous and
+                len(buffer.messages) >= min(self.app.history_limit, buffer.messages.maxlen))
+
+    def over_budget(self):
+        now = time.monotonic()
+        while self.started and now - self.started[0] > self.window:
+            self.started.popleft()
+        return len(self.started) >= self.budget
+
+    def warm(self, channel):
+        """Start prefetching `channel` unless it is warm, already queued or over budget, returns the task"""
+        task = self.tasks.get(channel.id)
+        if task is not None:
+            return task
+        if self.is_warm(channel) or self.app.router.get(channel.id) is not None or self.over_budget():
+            return None
+        task = self.tasks[channel.id] = asyncio.ensure_future(self.fetch(channel))
+        task.add_done_callback(lambda _: self.done(channel.id))
+        return task
+
+    def done(self, channel_id):
+        self.tasks.pop(channel_id, None)
+        self.hinted.discard(channel_id)
+
+    async def fetch(self, channel):
+        async with self.semaphore:
+            # The budget is spent when a fetch starts, hints dropped while queued cost nothing
+            if self.over_budget():
+                return
+            self.started.append(time.monotonic())
+            self.running.add(channel.id)
+            try:
+                with self.app.metrics.time("history.prefetch"):
+                    await self.app.buffers.history(channel, self.app.history_limit)
+            except (discord.HTTPException, asyncio.TimeoutError) as e:
+                print("Prefetch of {} failed: {}".format(channel.id, e))
+            finally:
+                self.running.discard(channel.id)
+
+    def hint(self, channel):
+        """
+        The user is pointing at `channel` in the chum list, warm it next.
+        Earlier hints still waiting for a slot are dropped, the pointer moved on
+        """
+        if self.warm(channel) is None:
+            return
+        for id in list(self.hinted):
+            if id != channel.id and id not in self.running:
+                self.tasks[id].cancel()
+        self.hinted.add(channel.id)
+
+    async def history(self, channel, limit):
+        """`ChannelBuffers.history`, after waiting for a prefetch of the same channel in flight"""
+        task = self.tasks.get(channel.id)
+        if task is not None:
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise
+        return await self.app.buffers.history(channel, limit)
+
+    def stop(self):
+        if self.startup is not None:
+            self.startup.cancel()
+        for task in list(self.tasks.values()):
+            task.cancel()
@@ -22,10 +22,10 @@
 from importlib import reload
 from random import choice
 import inspect
-import json
 import re
 import os
 
+from config import ConfigFile, cfgdir
 import pyquirks
 
 
@@ -33,11 +33,8 @@ class Quirks(object):
     def __init__(self, app):
         self.app = app
         self.id = self.app.client.user.id
-        if not os.path.exists("cfg/quirks.json"):
-            with open("cfg/quirks.json", 'w') as qf:
-                qf.write(json.dumps({self.id:list()}, indent=4))
-        with open("cfg/quirks.json", 'r') as qf:
-            self.allquirks = json.loads(qf.read())
+        self.store = ConfigFile(os.path.join(cfgdir, "quirks.json"), dict())
+        self.allquirks = self.store.data
 
         if str(self.id) not in self.allquirks.keys():
             self.allquirks[str(self.id)] = list()
@@ -75,11 +72,16 @@ class Quirks(object):
             print(e)
 
     def save_quirks(self):
-        with open("cfg/quirks.json", 'w') as qf:
-            qf.write(json.dumps(self.allquirks, indent=4))
+        self.store.save()
 
     def append(self, item):
         self.quirks.append(item)
+        self.store.changed()
+
+    def pop(self, index):
+        quirk = self.quirks.pop(index)
+        self.store.changed()
+        return quirk
 
     def reload(self):
         reload(pyquirks)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from datetime import datetime
+
+import discord
+
+from mentions import mention_pattern
+
+# MessageRecord.flags
+MENTIONS = 1
+CHANNEL_MENTIONS = 2
+ROLE_MENTIONS = 4
+mention_flags = {"@": MENTIONS, "@!": MENTIONS, "#": CHANNEL_MENTIONS, "@&": ROLE_MENTIONS}
+MENTIONS_EVERYONE = 8
+MENTIONS_ME = 16
+EDITED = 32
+ATTACHMENTS = 64
+TTS = 128
+
+
+class AuthorRecord(object):
+    """What formatting needs of a message author, one per author per guild"""
+    __slots__ = ("id", "display_name", "color")
+
+    def __init__(self, id, display_name, color):
+        self.id = id
+        self.display_name = display_name
+        self.color = color
+
+
+class MessageRecord(object):
+    """
+    A retained message. Everything else a `discord.Message` holds is either
+    looked up through `RecordTables` or reduced to a bit in `flags`
+    """
+    __slots__ = ("id", "author_id", "channel_id", "timestamp", "content", "flags")
+
+    def __init__(self, id, author_id, channel_id, timestamp, content, flags):
+        self.id = id
+        self.author_id = author_id
+        self.channel_id = channel_id
+        self.timestamp = timestamp
+        self.content = content
+        self.flags = flags
+
+
+class MessageView(object):
+    """
+    A `MessageRecord` with its author and channel looked up, duck typing the
+    parts of `discord.Message` that formatting reads. Made when a record is
+    displayed and dropped after
+    """
+    __slots__ = ("record", "author", "channel", "app")
+
+    def __init__(self, record, author, channel, app):
+        self.record = record
+        self.author = author
+        self.channel = channel
+        self.app = app
+
+    @property
+    def id(self):
+        return self.record.id
+
+    @property
+    def content(self):
+        return self.record.content
+
+    @property
+    def created_at(self):
+        return datetime.utcfromtimestamp(self.record.timestamp)
+
+    @property
+    def guild(self):
+        return getattr(self.channel, "guild", None)
+
+    def mentioned(self, flag, kind, get):
+        """Resolve the mentions of one `kind` in the content, only if the flag says there are any"""
+        if not self.record.flags & flag:
+            return []
+        found = list()
+        for match in mention_pattern.finditer(self.record.content):
+            if match.group(1) in kind:
+                item = get(int(match.group(2)))
+                if item is not None:
+                    found.append(item)
+        return found
+
+    @property
+    def mentions(self):
+        guild = self.guild
+        get = guild.get_member if guild is not None else self.app.members.get
+        return self.mentioned(MENTIONS, ("@", "@!"), get)
+
+    @property
+    def channel_mentions(self):
+        guild = self.guild
+        return self.mentioned(CHANNEL_MENTIONS, ("#",), guild.get_channel) if guild is not None else []
+
+    @property
+    def role_mentions(self):
+        guild = self.guild
+        return self.mentioned(ROLE_MENTIONS, ("@&",), guild.get_role) if guild is not None else []
+
+
+class RecordTables(object):
+    """
+    Converts `discord.Message`s to `MessageRecord`s for keeping, and back
+    to `MessageView`s for display. Authors and channels are interned here,
+    shared by every record that refers to them
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.authors = dict()  # (guild id, user id) -> AuthorRecord
+        self.channels = dict()  # channel id -> channel
+
+    def intern_author(self, guild_id, user):
+        color = getattr(user, "color", None) or discord.Color.default()
+        key = (guild_id, user.id)
+        author = self.authors.get(key)
+        if author is None:
+            author = self.authors[key] = AuthorRecord(user.id, user.display_name, color)
+        elif author.display_name != user.display_name or author.color != color:
+            author.display_name = user.display_name
+            author.color = color
+        return author
+
+    def update_author(self, user):
+        """Refresh an author after a member or user update"""
+        guild = getattr(user, "guild", None)
+        guild_id = guild.id if guild is not None else None
+        if (guild_id, user.id) in self.authors:
+            self.intern_author(guild_id, user)
+
+    def record(self, message):
+        channel = message.channel
+        self.channels[channel.id] = channel
+        guild = getattr(channel, "guild", None)
+        self.intern_author(guild.id if guild is not None else None, message.author)
+        flags = 0
+        for match in mention_pattern.finditer(message.content):
+            flags |= mention_flags[match.group(1)]
+        if message.mention_everyone:
+            flags |= MENTIONS_EVERYONE
+        if self.app.client.user.mentioned_in(message):
+            flags |= MENTIONS_ME
+        if message.edited_at is not None:
+            flags |= EDITED
+        if message.attachments:
+            flags |= ATTACHMENTS
+        if message.tts:
+            flags |= TTS
+        timestamp = message.created_at.replace(tzinfo=None) - datetime(1970, 1, 1)
+        return MessageRecord(message.id, message.author.id, channel.id,
+                             timestamp.total_seconds(), message.content, flags)
+
+    def view(self, record):
+        channel = self.channels.get(record.channel_id)
+        guild = getattr(channel, "guild", None)
+        author = self.authors.get((guild.id if guild is not None else None, record.author_id))
+        return MessageView(record, author, channel, self.app)
+
+    def forget_channel(self, channel_id):
+        self.channels.pop(channel_id, None)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from datetime import datetime
+from itertools import count
+import asyncio
+import gzip
+import json
+import time
+
+from aiohttp import web, WSMsgType
+
+DISCORD_EPOCH = 1420070400000
+
+BOT = {"id": "100000000000000001", "username": "pesterBot", "discriminator": "0001", "avatar": None, "bot": True}
+CHUM = {"id": "100000000000000002", "username": "carcinoGeneticist", "discriminator": "0002", "avatar": None}
+DM = {"id": "100000000000000003", "type": 1, "recipients": [CHUM], "last_message_id": None}
+
+lorem = ("hey did you see what terezi did to the hive, "
+         "i cant believe she actually went through with it")
+
+increment = count()
+
+
+def snowflake():
+    return str(((int(time.time() * 1000) - DISCORD_EPOCH) << 22) | (next(increment) % 4096))
+
+
+def stamp():
+    """Marks a message with the time it left the server, see `loadtest.py`"""
+    return "[lt:{:.6f}]".format(time.time())
+
+
+def message_payload(channel_id, author, content):
+    return {"id": snowflake(), "channel_id": channel_id, "author": author, "content": content,
+            "timestamp": datetime.utcnow().isoformat() + "+00:00", "edited_timestamp": None,
+            "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [],
+            "attachments": [], "embeds": [], "pinned": False, "type": 0}
+
+
+class EventRecorder(object):
+    """
+    Records gateway dispatch events to a gzipped JSON lines file, each with
+    its time since recording started, for `FakeDiscord` to replay
+    """
+
+    def __init__(self, path):
+        self.file = gzip.open(path, 'wt')
+        self.started = time.monotonic()
+
+    def record(self, payload):
+        if payload.get("op") == 0:
+            event = {"t": round(time.monotonic() - self.started, 4), "e": payload["t"], "d": payload["d"]}
+            self.file.write(json.dumps(event, separators=(",", ":")))
+            self.file.write("\n")
+
+    def close(self):
+        self.file.close()
+
+
+def load_recording(path):
+    with gzip.open(path, 'rt') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class FakeDiscord(object):
+    """
+    A local stand-in for Discord's gateway and REST API. After READY it
+    streams a recording, or synthetic DM messages from one chum at `rate`
+    messages a second for `duration` seconds. With a recording and no rate
+    the recorded timing is kept, sped up by `speed`. Sent messages are
+    echoed back over the gateway like Discord does
+    """
+    warmup = 3  # seconds between READY and the first event, while the client settles
+
+    def __init__(self, rate=None, duration=10, recording=None, speed=1.0):
+        self.rate = rate
+        self.duration = duration
+        self.speed = speed
+        self.events = list()
+        self.ready = {"v": 6, "user": BOT, "guilds": [], "private_channels": [DM],
+                      "session_id": "loadtest", "relationships": []}
+        if recording is not None:
+            events = load_recording(recording)
+            ready = next(event for event in events if event["e"] == "READY")
+            self.ready = ready["d"]
+            self.events = [dict(event, t=event["t"] - ready["t"]) for event in events if event["t"] > ready["t"]]
+        self.user = self.ready["user"]
+        self.ws = None
+        self.seq = 0
+
+        self.app = web.Application()
+        self.app.router.add_get("/ws", self.websocket)
+        self.app.router.add_get("/api/{version}/gateway", self.gateway)
+        self.app.router.add_get("/api/{version}/gateway/bot", self.gateway)
+        self.app.router.add_get("/api/{version}/users/@me", self.me)
+        self.app.router.add_post("/api/{version}/channels/{channel_id}/messages", self.create_message)
+        self.app.router.add_get("/api/{version}/channels/{channel_id}/messages", self.history)
+        self.app.router.add_route("*", "/{tail:.*}", self.fallback)
+
+    async def gateway(self, request):
+        return web.json_response({"url": "ws://{}/ws".format(request.host), "shards": 1,
+                                  "session_start_limit": {"total": 1000, "remaining": 1000,
+                                                          "reset_after": 0, "max_concurrency": 1}})
+
+    async def me(self, request):
+        return web.json_response(self.user)
+
+    async def history(self, request):
+        return web.json_response([])
+
+    async def fallback(self, request):
+        return web.json_response({})
+
+    async def create_message(self, request):
+        body = await request.json()
+        data = message_payload(request.match_info["channel_id"], self.user, body.get("content", ""))
+        data["nonce"] = body.get("nonce")
+        if self.ws is not None:
+            await self.dispatch("MESSAGE_CREATE", data)
+        return web.json_response(data)
+
+    async def websocket(self, request):
+        self.ws = ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({"op": 10, "d": {"heartbeat_interval": 41250}})
+        stream = None
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                payload = json.loads(msg.data)
+                if payload["op"] == 1:
+                    await ws.send_json({"op": 11})
+                elif payload["op"] == 2 and stream is None:
+                    await self.dispatch("READY", self.ready)
+                    stream = asyncio.ensure_future(self.stream())
+        finally:
+            if stream is not None:
+                stream.cancel()
+            self.ws = None
+        return ws
+
+    async def dispatch(self, event, data):
+        self.seq += 1
+        await self.ws.send_str(json.dumps({"op": 0, "t": event, "s": self.seq, "d": data}))
+
+    async def stream(self):
+        await asyncio.sleep(self.warmup)
+        if self.events:
+            await self.replay()
+        else:
+            await self.synthetic()
+
+    async def synthetic(self):
+        started = time.monotonic()
+        total = int(self.rate * self.duration)
+        for sent in range(total):
+            # Sleeping per message can't keep up with high rates, send whatever is due
+            delay = started + sent / self.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.dispatch("MESSAGE_CREATE", message_payload(DM["id"], CHUM, "{} {}".format(lorem, stamp())))
+
+    async def replay(self):
+        started = time.monotonic()
+        for i, event in enumerate(self.events):
+            at = i / self.rate if self.rate else event["t"] / self.speed
+            delay = started + at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            data = event["d"]
+            if event["e"] == "MESSAGE_CREATE":
+                data = dict(data, content="{} {}".format(data["content"], stamp()))
+            await self.dispatch(event["e"], data)
+
+
+def run_server(port, **kwargs):
+    """Serve a `FakeDiscord` on localhost until killed, the target of the load test's server process"""
+    web.run_app(FakeDiscord(**kwargs).app, host="127.0.0.1", port=port, print=None)
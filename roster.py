@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from bisect import bisect_left
+import asyncio
+import os
+
+import discord
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QSortFilterProxyModel
+from PyQt5.QtGui import QBrush, QColor, QStandardItem, QStandardItemModel
+
+from formatting import fmt_unread
+
+
+class UpdateCoalescer(object):
+    """
+    Collects keyed updates and hands only the latest one per key to `apply`,
+    at most once every `interval` seconds. A presence storm from a large
+    guild then costs one batched model update per tick
+    """
+
+    def __init__(self, apply, interval=0.25):
+        self.apply = apply
+        self.interval = interval
+        self.pending = dict()
+        self.handle = None
+
+    def push(self, key, value):
+        self.pending[key] = value
+        if self.handle is None:
+            self.handle = asyncio.get_event_loop().call_later(self.interval, self.flush)
+
+    def flush(self):
+        self.handle = None
+        pending, self.pending = self.pending, dict()
+        if pending:
+            self.apply(pending)
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.pending.clear()
+
+
+class MemberListModel(QAbstractListModel):
+    """
+    The hoist-sorted member list of a guild, shared by every channel tab of
+    its memo. Sort keys are computed on the client's thread, where the
+    guild's members and roles are updated, and rows are handed to the view
+    lazily through `fetchMore`. Member events update single rows
+    """
+    fetch_chunk = 200
+
+    def __init__(self, app, guild, parent=None):
+        QAbstractListModel.__init__(self, parent)
+        self.app = app
+        self.guild = guild
+        self.keys = list()  # sorted (-hoist position, name, id)
+        self.loaded = 0  # rows exposed to views
+        self.info = dict()  # member id -> (sort key, is op, color value)
+        self.brushes = dict()  # color value -> QBrush
+        self.updates = UpdateCoalescer(self.apply_updates)
+        self.ready = False
+        self.task = asyncio.ensure_future(self.populate())
+
+    async def populate(self):
+        self.info = await self.app.read_client(self.sort_all)
+        self.beginResetModel()
+        self.keys = sorted(info[0] for info in self.info.values())
+        self.loaded = min(len(self.keys), self.fetch_chunk)
+        self.ready = True
+        self.endResetModel()
+
+    def sort_all(self):
+        """Sort info of every member, called on the client's thread"""
+        return {member.id: self.sort_info(member) for member in self.guild.members}
+
+    def sort_some(self, ids):
+        """Sort info of the members `ids`, None for those who left. Called on the client's thread"""
+        infos = dict()
+        for id in ids:
+            member = self.guild.get_member(id)
+            infos[id] = self.sort_info(member) if member is not None else None
+        return infos
+
+    @staticmethod
+    def sort_info(member):
+        hoist = max((role.position for role in member.roles if role.hoist), default=0)
+        key = (-hoist, member.display_name.lower(), member.id)
+        return key, member.top_role.permissions.administrator, member.color.value
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.loaded
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.loaded < len(self.keys)
+
+    def fetchMore(self, parent=QModelIndex()):
+        count = min(self.fetch_chunk, len(self.keys) - self.loaded)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self.loaded, self.loaded + count - 1)
+        self.loaded += count
+        self.endInsertRows()
+
+    def member(self, index):
+        """Get the `discord.Member` displayed at a model index"""
+        if not index.isValid() or index.row() >= self.loaded:
+            return None
+        return self.guild.get_member(self.keys[index.row()][2])
+
+    def data(self, index, role=Qt.DisplayRole):
+        member = self.member(index)
+        if member is None:
+            return None
+        if role == Qt.DisplayRole:
+            return member.display_name
+        elif role == Qt.ForegroundRole:
+            value = self.info[member.id][2]
+            brush = self.brushes.get(value)
+            if brush is None:
+                clr = discord.Colour(value)
+                brush = self.brushes[value] = QBrush(QColor(clr.r, clr.g, clr.b))
+            return brush
+        elif role == Qt.DecorationRole:
+            if self.info[member.id][1]:
+                return self.app.assets.icon("op.png")
+        elif role == Qt.UserRole:
+            return member.id
+        return None
+
+    def add(self, id, info):
+        if id in self.info:
+            self.remove(id)
+        self.info[id] = info
+        if not self.ready:
+            return
+        row = bisect_left(self.keys, info[0])
+        if row <= self.loaded:
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.keys.insert(row, info[0])
+            self.loaded += 1
+            self.endInsertRows()
+        else:
+            self.keys.insert(row, info[0])
+
+    def remove(self, id):
+        info = self.info.pop(id, None)
+        if info is None or not self.ready:
+            return
+        row = bisect_left(self.keys, info[0])
+        if row >= len(self.keys) or self.keys[row] != info[0]:
+            return
+        if row < self.loaded:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.keys[row]
+            self.loaded -= 1
+            self.endRemoveRows()
+        else:
+            del self.keys[row]
+
+    def update(self, member):
+        """Queue a member join or update, applied with the others of the same tick"""
+        self.updates.push(member.id, member)
+
+    def apply_updates(self, members):
+        asyncio.ensure_future(self.refresh(list(members)))
+
+    async def refresh(self, ids):
+        """
+        Re-sort members whose sort key, op status or color changed, and
+        repaint the rest with a single dataChanged
+        """
+        rows = list()
+        for id, new in (await self.app.read_client(self.sort_some, ids)).items():
+            old = self.info.get(id)
+            if new is None:
+                continue  # Left, `remove` was called for them
+            if old is None or old[:2] != new[:2]:
+                self.add(id, new)
+                continue
+            self.info[id] = new
+            if self.ready:
+                row = bisect_left(self.keys, old[0])
+                if row < self.loaded:
+                    rows.append(row)
+        if rows:
+            self.dataChanged.emit(self.index(min(rows)), self.index(max(rows)))
+
+
+class ChumsModel(QStandardItemModel):
+    """
+    The chum list, one row per private channel keyed by channel id. It lives
+    on the App so it survives `Gui.initialize` and theme changes, and is
+    updated from channel events instead of being rebuilt
+    """
+    ChannelRole = Qt.UserRole
+    MoodRole = Qt.UserRole + 1
+    NameRole = Qt.UserRole + 2
+
+    def __init__(self, app, parent=None):
+        QStandardItemModel.__init__(self, parent)
+        self.app = app
+        self.items = dict()  # channel id -> QStandardItem
+        self.channels = dict()  # channel id -> DMChannel / GroupChannel
+        self.recipients = dict()  # user id -> {channel id}
+        self.online = 0
+        self.moodUpdates = UpdateCoalescer(self.set_moods)
+        self.update_header()
+
+    @staticmethod
+    def channel_name(channel):
+        if isinstance(channel, discord.GroupChannel):
+            if not channel.name:
+                return ", ".join(map(lambda c: c.display_name, channel.recipients))
+            return channel.name
+        return channel.recipient.display_name
+
+    @staticmethod
+    def channel_recipients(channel):
+        if isinstance(channel, discord.GroupChannel):
+            return channel.recipients
+        return [channel.recipient]
+
+    def rebuild(self, channels):
+        """Diff the model against `channels`, adding and removing only what changed"""
+        channels = {channel.id: channel for channel in channels}
+        for id in list(self.items.keys()):
+            if id not in channels:
+                self.remove_channel(self.channels[id])
+        for channel in channels.values():
+            if channel.id in self.items:
+                self.update_channel(channel)
+            else:
+                self.add_channel(channel)
+
+    def add_channel(self, channel, mood=None):
+        if channel.id in self.items:
+            return self.update_channel(channel)
+        if mood is None:
+            mood = self.channel_mood(channel)
+        item = QStandardItem()
+        item.setEditable(False)
+        item.setData(channel.id, self.ChannelRole)
+        item.setData(self.channel_name(channel), self.NameRole)
+        self.set_item_label(item)
+        self.items[channel.id] = item
+        self.channels[channel.id] = channel
+        for user in self.channel_recipients(channel):
+            self.recipients.setdefault(user.id, set()).add(channel.id)
+        self.set_item_mood(item, mood)
+        self.appendRow(item)
+        self.update_header()
+
+    def remove_channel(self, channel):
+        item = self.items.pop(channel.id, None)
+        if item is None:
+            return
+        self.channels.pop(channel.id)
+        for user in self.channel_recipients(channel):
+            self.recipients.get(user.id, set()).discard(channel.id)
+        if item.data(self.MoodRole) != "offline":
+            self.online -= 1
+        self.removeRow(item.row())
+        self.update_header()
+
+    def update_channel(self, channel):
+        """Refresh a row after a channel rename or a change of recipients"""
+        item = self.items.get(channel.id)
+        if item is None:
+            return self.add_channel(channel)
+        self.channels[channel.id] = channel
+        for user in self.channel_recipients(channel):
+            self.recipients.setdefault(user.id, set()).add(channel.id)
+        name = self.channel_name(channel)
+        if item.data(self.NameRole) != name:
+            item.setData(name, self.NameRole)
+            self.set_item_label(item)
+
+    def set_item_label(self, item):
+        """Label a row with its name and unread counters, bold while anything is unread"""
+        unread, mentions = self.app.buffers.counts(item.data(self.ChannelRole))
+        counter = fmt_unread(unread, mentions)
+        item.setText("{} ({})".format(item.data(self.NameRole), counter) if counter else item.data(self.NameRole))
+        font = item.font()
+        if font.bold() != bool(unread):
+            font.setBold(bool(unread))
+            item.setFont(font)
+
+    def update_unread(self, channel_id):
+        item = self.items.get(channel_id)
+        if item is not None:
+            self.set_item_label(item)
+
+    def update_user(self, user):
+        """Refresh the rows of every channel `user` is a recipient of"""
+        for id in self.recipients.get(user.id, ()):
+            self.update_channel(self.channels[id])
+
+    def channel(self, index):
+        """Get the channel of a (source model) index"""
+        return self.channels.get(self.data(index, self.ChannelRole))
+
+    def channel_mood(self, channel):
+        """
+        The mood of a DM is its recipient's, a group is chummy while anyone
+        in it is online. Presence is only known for users sharing a guild
+        """
+        moods = list()
+        for user in self.channel_recipients(channel):
+            member = self.app.members.get(user.id)
+            if hasattr(member, "status"):
+                moods.append(self.app.moods.from_presence(member.status, member.activities))
+            else:
+                moods.append("offline")
+        if isinstance(channel, discord.GroupChannel):
+            return "chummy" if any(mood != "offline" for mood in moods) else "offline"
+        return moods[0] if moods else "offline"
+
+    def update_presence(self, user):
+        """Queue a mood update for every channel `user` is a recipient of"""
+        for id in self.recipients.get(user.id, ()):
+            self.moodUpdates.push(id, self.channel_mood(self.channels[id]))
+
+    def set_mood(self, channel_id, mood):
+        self.set_moods({channel_id: mood})
+
+    def set_moods(self, moods):
+        """
+        Apply a batch of {channel id: mood} with signals blocked, then report
+        the changed rows to the proxy with one dataChanged
+        """
+        rows = list()
+        self.blockSignals(True)
+        try:
+            for id, mood in moods.items():
+                item = self.items.get(id)
+                if item is not None and item.data(self.MoodRole) != mood:
+                    self.set_item_mood(item, mood)
+                    rows.append(item.row())
+        finally:
+            self.blockSignals(False)
+        if rows:
+            self.dataChanged.emit(self.index(min(rows), 0), self.index(max(rows), 0))
+            self.update_header()
+
+    def set_item_mood(self, item, mood):
+        old = item.data(self.MoodRole)
+        if old is not None and old != "offline":
+            self.online -= 1
+        if mood != "offline":
+            self.online += 1
+        item.setData(mood, self.MoodRole)
+        item.setIcon(self.app.assets.icon(mood + ".png"))
+
+    def refresh_icons(self):
+        """Reload every mood icon from the current theme"""
+        for item in self.items.values():
+            item.setIcon(self.app.assets.icon(item.data(self.MoodRole) + ".png"))
+
+    def update_header(self):
+        if self.app.options["chum_list"]["show_number_of_online_chums"]:
+            label = "Chums ({}/{})".format(self.online, len(self.items))
+        else:
+            label = "Chums"
+        if self.headerData(0, Qt.Horizontal) != label:
+            self.setHorizontalHeaderLabels([label])
+
+
+class ChumsProxyModel(QSortFilterProxyModel):
+    """Sorts and filters `ChumsModel` according to the chum list options"""
+
+    def __init__(self, app, parent=None):
+        QSortFilterProxyModel.__init__(self, parent)
+        self.app = app
+        self.setSortCaseSensitivity(Qt.CaseInsensitive)
+        self.setDynamicSortFilter(True)
+        self.setSortRole(ChumsModel.NameRole)
+
+    def filterAcceptsRow(self, row, parent):
+        if self.app.options["chum_list"]["hide_offline_chums"]:
+            index = self.sourceModel().index(row, 0, parent)
+            return self.sourceModel().data(index, ChumsModel.MoodRole) != "offline"
+        return True
+
+    def lessThan(self, left, right):
+        if self.app.options["chum_list"]["sort_chums"] == 1:
+            model = self.sourceModel()
+            lmood = self.app.moods.getMood(model.data(left, ChumsModel.MoodRole))
+            rmood = self.app.moods.getMood(model.data(right, ChumsModel.MoodRole))
+            if lmood != rmood:
+                return lmood < rmood
+        return QSortFilterProxyModel.lessThan(self, left, right)
+
+    def refresh(self):
+        """Re-apply the sort and filter after the chum list options change"""
+        self.invalidate()
+        self.sort(0)
+        self.sourceModel().update_header()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+class Router(object):
+    """
+    Channel id -> the chat widget showing that channel, so an incoming
+    message finds its widget in constant time. Windows add a route when a
+    channel's widget is built and remove it when the widget goes away
+    """
+
+    def __init__(self):
+        self.routes = dict()
+
+    def add(self, channel_id, widget):
+        self.routes[channel_id] = widget
+
+    def remove(self, channel_id, widget=None):
+        """Remove the route of `channel_id`, only if it still leads to `widget` when given"""
+        if widget is None or self.routes.get(channel_id) is widget:
+            self.routes.pop(channel_id, None)
+
+    def get(self, channel_id):
+        return self.routes.get(channel_id)
+
+    def __contains__(self, channel_id):
+        return channel_id in self.routes
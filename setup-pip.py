@@ -4,7 +4,7 @@ from setuptools import setup
 include_files = ["resources", "themes", "README.md", "LICENSE"]
 
 build_exe_options = {
-    "includes": ["PyQt5", "os", "json", "asyncio", "types", "discord", "aiohttp", "requests"],
+    "includes": ["PyQt5", "os", "json", "asyncio", "types", "discord", "aiohttp"],
     "excludes": ["tkinter", "_tkinter", '_gtkagg', '_tkagg', 'bsddb', 'curses',
                  'pywin.debugger', 'pywin.debugger.dbgcon', 'pywin.dialogs', 'tcl',
                  'unittest', 'idlelib', 'certifi', 'nacl', "_lzma", "_hashlib", "_bz2"],
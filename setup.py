@@ -27,7 +27,7 @@ sys.argv.append("build")
 include_files = ["resources", "themes", "README.md", "LICENSE"]
 
 includes = ["PyQt5", "os", "json", "types", "discord", "aiohttp",
-            "requests", "contextlib", "io", "inspect", "traceback", "subprocess",
+            "contextlib", "io", "inspect", "traceback", "subprocess",
             "async_timeout", "asyncio", "asyncio.base_futures",
             "asyncio.base_events", "asyncio.base_tasks", "asyncio.base_subprocess",
             "asyncio.proactor_events", "asyncio.constants", "asyncio.selector_events",
@@ -21,9 +21,24 @@
 
 import os
 import json
+import re
 
 themes = dict()
 
+# A rule rich text can use: selectors are lowercase tags or classes, Qt widget classes are capitalized
+rule_pattern = re.compile(r"([^{}]+)\{([^{}]*)\}")
+document_selector = re.compile(r"^(?:[a-z][a-z0-9]*)?(?:\.[a-z][\w-]*)?$")
+
+
+def document_styles(styles):
+    """Extract the rules of a theme stylesheet that apply inside chat documents, without repeats"""
+    rules = dict()
+    for selectors, body in rule_pattern.findall(styles):
+        selectors = [selector.strip() for selector in selectors.split(",")]
+        if all(selector and document_selector.match(selector) for selector in selectors):
+            rules["{}{{{}}}".format(",".join(selectors), " ".join(body.split()))] = None
+    return "".join(rules)
+
 
 def getThemes(themes):
     """
@@ -69,5 +84,7 @@ def getThemes(themes):
                     data["styles"] = "\n".join([themes[data["inherits"]]["styles"], data["styles"]])
                 except Exception:
                     continue
+        for data in themes.values():
+            data["document_styles"] = document_styles(data["styles"])
     return themes
 themes = getThemes(themes)
@@ -21,74 +21,291 @@
 
 from stat import S_IWUSR
 import subprocess
-import requests
+import hashlib
+import asyncio
 import zipfile
 import shutil
+import json
 import sys
 import os
 
+from web import HttpClient, hash_file
 
-def get_update(url):
-    print("Downloading update from {}".format(url))
+RELEASES_URL = "https://api.github.com/repos/henry232323/pesterchum-discord/releases/latest"
+MANIFEST_NAME = "manifest.json"
+STAGING = "update"
+READY = os.path.join(STAGING, "ready.json")
+ASIDE = os.path.join(STAGING, "aside.json")  # Files `swap_in` renamed aside, for `remove_old`
 
-    if not os.path.exists("temp"):
-        os.mkdir("temp")
-    cachepath = "temp/master.zip"
-    with open(cachepath, "wb") as f:
-        print("Downloading %s" % cachepath)
-        response = requests.get(url, stream=True)
-        total_length = response.headers.get('content-length')
+to_copy = ["resources", "themes",
+           "python36.zip", "python36.dll", "pywintypes36.dll",
+           "asyncio", "discord"]
 
-        if total_length is None:  # no content length header
-            f.write(response.content)
-        else:
-            dl = 0
-            total_length = int(total_length)
-            for data in response.iter_content(chunk_size=4096):
-                dl += len(data)
-                f.write(data)
-                done = int(50 * dl / total_length)
-                sys.stdout.write("\r[%s%s]" % ('\u2588' * done, ' ' * (50 - done)))
-                sys.stdout.flush()
-
-    zip_ref = zipfile.ZipFile(cachepath, 'r')
-    zip_ref.extractall("temp")
-    zip_ref.close()
-
-    to_copy = ["resources", "themes",
-               "python36.zip", "python36.dll", "pywintypes36.dll",
-               "asyncio", "discord"]
-    for cfile in to_copy:
-        fn = "temp/{}".format(cfile)
-        if os.path.isfile(fn):
-            shutil.copy(fn, "./{}".format(cfile))
+
+def show_progress(dl, total_length):
+    if total_length:
+        done = int(50 * dl / total_length)
+        sys.stdout.write("\r[%s%s]" % ('\u2588' * done, ' ' * (50 - done)))
+        sys.stdout.flush()
+
+
+def release_asset(release):
+    """The manifest asset of a GitHub release if it publishes one, otherwise its zip"""
+    for asset in release["assets"]:
+        if asset["name"] == MANIFEST_NAME:
+            return asset
+    return release["assets"][0]
+
+
+def release_url(release):
+    return release_asset(release)["browser_download_url"]
+
+
+def asset_sha256(asset):
+    """GitHub publishes asset digests as "sha256:<hex>", older releases have none"""
+    digest = asset.get("digest") or ""
+    return digest[7:] if digest.startswith("sha256:") else None
+
+
+async def latest_release(http):
+    return release_url(await http.get_json(RELEASES_URL))
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    hash_file(digest, path)
+    return digest.hexdigest()
+
+
+def build_manifest(version, base_url, root="."):
+    """
+    Build the manifest published with a release: the sha256 and size of every
+    file shipped, fetched individually from `base_url` + its path
+    """
+    files = dict()
+    for cfile in to_copy + ["pesterchum.exe"]:
+        fn = os.path.join(root, cfile)
+        paths = [fn] if os.path.isfile(fn) else [
+            os.path.join(dp, f) for dp, dn, fns in os.walk(fn) for f in fns]
+        for path in paths:
+            rp = os.path.relpath(path, root).replace(os.sep, "/")
+            files[rp] = dict(sha256=file_hash(path), size=os.path.getsize(path))
+    return dict(version=version, base_url=base_url, files=files)
+
+
+def changed_files(manifest, root="."):
+    """Paths in `manifest` whose installed copy is missing or differs"""
+    changed = list()
+    for path, entry in manifest["files"].items():
+        local = os.path.join(root, path)
+        if (not os.path.isfile(local) or os.path.getsize(local) != entry["size"]
+                or file_hash(local) != entry["sha256"]):
+            changed.append(path)
+    return changed
+
+
+async def fetch_verified(http, url, dest, sha256=None, progress=None):
+    """
+    Download `url` to `dest`, resuming from a previous partial download and
+    hashing bytes as they arrive. A file failing its checksum is deleted so
+    the next attempt starts over
+    """
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    part = dest + ".part"
+    digest = hashlib.sha256()
+    await http.download(url, part, progress=progress, digest=digest, resume=True)
+    if sha256 is not None and digest.hexdigest() != sha256:
+        os.remove(part)
+        raise ValueError("Checksum mismatch for {}".format(url))
+    os.replace(part, dest)
+
+
+async def fetch_changed(http, manifest, paths):
+    """Download every path in `paths` to the staging directory in parallel"""
+    await asyncio.gather(*(
+        fetch_verified(http, manifest["base_url"] + path, os.path.join(STAGING, path), manifest["files"][path]["sha256"])
+        for path in paths))
+
+
+def extract_release(archive):
+    """Extract the shipped files of a release zip into the staging directory, returns their paths"""
+    paths = list()
+    with zipfile.ZipFile(archive, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir() or info.filename.split("/")[0] not in to_copy:
+                continue
+            zip_ref.extract(info, STAGING)
+            paths.append(info.filename)
+    os.remove(archive)
+    return paths
+
+
+def staged_version():
+    """The version of the verified update waiting in the staging directory, if any"""
+    try:
+        with open(READY, 'r') as rf:
+            return json.load(rf)["version"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+async def stage_update(http, url, version=None, sha256=None, progress=None):
+    """
+    Download the update at `url` (a manifest or a release zip) into the
+    staging directory. Interrupted downloads pick up where they stopped.
+    Nothing is installed here, `apply_staged` does that on the next launch
+    once the ready marker is written
+    """
+    loop = asyncio.get_event_loop()
+    if url.endswith(".json"):
+        manifest = await http.get_json(url, cache=False)
+        version = manifest["version"]
+        if staged_version() == version:
+            return version
+        # Hashing the install reads every file, keep it off the event loop
+        paths = await loop.run_in_executor(None, changed_files, manifest)
+        print("{} of {} files changed in {}".format(len(paths), len(manifest["files"]), version))
+        await fetch_changed(http, manifest, paths)
+    else:
+        version = version or url
+        if staged_version() == version:
+            return version
+        archive = os.path.join(STAGING, "master.zip")
+        await fetch_verified(http, url, archive, sha256, progress=progress)
+        paths = await loop.run_in_executor(None, extract_release, archive)
+    os.makedirs(STAGING, exist_ok=True)
+    with open(READY + ".tmp", 'w') as rf:
+        json.dump(dict(version=version, paths=paths), rf)
+    os.replace(READY + ".tmp", READY)
+    return version
+
+
+def swap_in(paths, root="."):
+    """
+    Move staged files over the installed ones. Installed files are renamed
+    aside first (a running executable can be renamed but not overwritten),
+    and everything is put back if any move fails
+    """
+    moved = list()
+    aside = list()
+    try:
+        for path in paths:
+            target = os.path.join(root, path)
+            os.makedirs(os.path.dirname(target) or root, exist_ok=True)
+            if os.path.exists(target):
+                os.replace(target, target + ".old")
+                aside.append(target + ".old")
+            moved.append(target)
+            os.replace(os.path.join(STAGING, path), target)
+    except OSError:
+        for target in reversed(moved):
+            if os.path.exists(target + ".old"):
+                os.replace(target + ".old", target)
+        raise
+    write_aside(read_aside() + aside)
+
+
+def read_aside():
+    try:
+        with open(ASIDE, 'r') as rf:
+            return json.load(rf)
+    except (OSError, ValueError):
+        return list()
+
+
+def write_aside(paths):
+    os.makedirs(STAGING, exist_ok=True)
+    with open(ASIDE + ".tmp", 'w') as wf:
+        json.dump(paths, wf)
+    os.replace(ASIDE + ".tmp", ASIDE)
+
+
+def remove_old():
+    """
+    Delete the files the last `swap_in` renamed aside, and nothing else.
+    Files still in use (the previous executable, while it exits) are kept
+    on the list for the next launch
+    """
+    if not os.path.exists(ASIDE):
+        return
+    left = list()
+    for path in read_aside():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            left.append(path)
+    if left:
+        write_aside(left)
+    else:
+        os.remove(ASIDE)
+        try:
+            os.rmdir(STAGING)
+        except OSError:
+            pass  # An update is being staged
+
+
+def clear_staging():
+    """Remove the staged files of an applied update, keeping the list of files set aside"""
+    os.remove(READY)  # First, so a partly cleared update is never applied again
+    for name in os.listdir(STAGING):
+        path = os.path.join(STAGING, name)
+        if path == ASIDE:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, onerror=onerror)
         else:
-            for root, dirs, files in os.walk(fn):
-                rp = root[5:]
-                for dir in dirs:
-                    dp = "{}/{}".format(rp, dir)
-                    if not os.path.exists(dp):
-                        os.makedirs(dp)
-                for file in files:
-                    try:
-                        shutil.copy("{}/{}".format(root, file), "{}/{}".format(rp, file))
-                    except PermissionError as e:
-                        print(e)
-
-    def onerror(func, path, exc_info):
-        if not os.access(path, os.W_OK):
-            # Is the error an access error ?
-            os.chmod(path, S_IWUSR)
-            func(path)
-
-    shutil.rmtree("temp", onerror=onerror)
+            os.remove(path)
+
+
+def onerror(func, path, exc_info):
+    if not os.access(path, os.W_OK):
+        # Is the error an access error ?
+        os.chmod(path, S_IWUSR)
+        func(path)
+
+
+def apply_staged():
+    """Install a verified staged update, returns its version or None if there isn't one"""
+    version = staged_version()
+    if version is None:
+        return None
+    with open(READY, 'r') as rf:
+        paths = json.load(rf)["paths"]
+    swap_in(paths)
+    clear_staging()
+    print("Updated to {}".format(version))
+    return version
+
+
+def get_update(url):
+    print("Downloading update from {}".format(url))
+
+    remove_old()
+    loop = asyncio.get_event_loop()
+    http = HttpClient(loop)
+    try:
+        loop.run_until_complete(stage_update(http, url, progress=show_progress))
+    finally:
+        loop.run_until_complete(http.close())
+    apply_staged()
     subprocess.Popen("start pesterchum.exe", shell=True)
     sys.exit()
 
-if len(sys.argv) > 1:
-    get_update(sys.argv[-1])
-else:
-    response = requests.get("https://api.github.com/repos/henry232323/pesterchum-discord/releases/latest").json()
-    current_version = response["tag_name"]
-    download_url = response["assets"][0]["browser_download_url"]
-    get_update(download_url)
\ No newline at end of file
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3 and sys.argv[1] == "--manifest":
+        # Run against a built release: updater.py --manifest <version> <base url>
+        with open(MANIFEST_NAME, 'w') as mf:
+            json.dump(build_manifest(sys.argv[2], sys.argv[3]), mf, indent=4)
+    elif len(sys.argv) > 1:
+        get_update(sys.argv[-1])
+    else:
+        loop = asyncio.get_event_loop()
+        http = HttpClient(loop)
+        try:
+            download_url = loop.run_until_complete(latest_release(http))
+        finally:
+            loop.run_until_complete(http.close())
+        get_update(download_url)
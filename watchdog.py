@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import threading
+import traceback
+import json
+import time
+import sys
+import os
+
+from config import atomic_write, cfgdir
+
+appdir = os.path.dirname(os.path.abspath(__file__))
+
+
+class StallWatchdog(object):
+    """
+    Watches the event loop from another thread. The loop bumps a heartbeat
+    every `interval` seconds, when it misses it by more than `threshold`
+    the loop thread's stack is captured right then. Stalls are aggregated
+    by the innermost call site in our own code and written to `path`
+    """
+
+    def __init__(self, loop, threshold=0.25, interval=0.05, path=os.path.join(cfgdir, "stalls.json"), metrics=None):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.path = path
+        self.metrics = metrics
+        self.ident = threading.get_ident()  # Created on the loop's thread
+        self.beat = time.monotonic()
+        self.stalls = dict()  # call site -> aggregate
+        self.lock = threading.Lock()
+        self.writeLock = threading.Lock()  # The watcher and stop() both write the report
+        self.dirty = False
+        self.running = False
+        self.thread = threading.Thread(target=self.watch, name="StallWatchdog", daemon=True)
+
+    def start(self):
+        self.running = True
+        self.loop.call_soon(self.heartbeat)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread.is_alive():
+            self.thread.join(self.interval * 4)
+        self.write_report()
+
+    def heartbeat(self):
+        self.beat = time.monotonic()
+        if self.running:
+            self.loop.call_later(self.interval, self.heartbeat)
+
+    def watch(self):
+        stalled = None  # (beat, call site) of the stall in progress
+        last_write = time.monotonic()
+        while self.running:
+            time.sleep(self.interval)
+            beat = self.beat
+            now = time.monotonic()
+            if stalled is not None and beat != stalled[0]:
+                # The loop is back, charge the whole stall to where it was caught
+                self.finish(stalled[1], beat - stalled[0] - self.interval)
+                stalled = None
+            if stalled is None and now - beat - self.interval > self.threshold:
+                frame = sys._current_frames().get(self.ident)
+                if frame is not None:
+                    stalled = (beat, self.capture(frame))
+            if self.dirty and now - last_write > 60:
+                self.write_report()
+                last_write = now
+
+    def capture(self, frame):
+        stack = traceback.extract_stack(frame)
+        ours = [entry for entry in stack if entry.filename.startswith(appdir)]
+        site = (ours or stack)[-1]
+        key = "{}:{} in {}".format(os.path.relpath(site.filename, appdir), site.lineno, site.name)
+        with self.lock:
+            if key not in self.stalls:
+                self.stalls[key] = dict(count=0, total=0.0, max=0.0, stack="".join(traceback.format_list(stack)))
+        return key
+
+    def finish(self, key, duration):
+        with self.lock:
+            stall = self.stalls[key]
+            stall["count"] += 1
+            stall["total"] += duration
+            stall["max"] = max(stall["max"], duration)
+            self.dirty = True
+        if self.metrics is not None:
+            self.loop.call_soon_threadsafe(self.metrics.observe, "loop.stall", duration)
+
+    def report(self):
+        """Stalls by call site, the most total time blocked first"""
+        with self.lock:
+            return sorted(({"site": key, **stall} for key, stall in self.stalls.items()),
+                          key=lambda stall: stall["total"], reverse=True)
+
+    def write_report(self):
+        with self.writeLock:
+            self.dirty = False
+            report = self.report()
+            if report:
+                atomic_write(self.path, json.dumps(dict(threshold=self.threshold, stalls=report), indent=4))
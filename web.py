@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016-2020, henry232323
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from collections import deque, namedtuple
+from urllib.parse import urlsplit
+import threading
+import hashlib
+import asyncio
+import json
+import time
+import os
+
+import aiohttp
+
+Response = namedtuple("Response", ("status", "headers", "body", "cached"))
+Timing = namedtuple("Timing", ("method", "host", "status", "elapsed", "size", "cached"))
+
+
+def hash_file(digest, path):
+    """Feed the contents of `path` to the hashlib object `digest`"""
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+
+
+class HttpClient(object):
+    """
+    The one HTTP client for everything that isn't the Discord API: CDN
+    assets, the update check and the updater. Connections are pooled in a
+    single `aiohttp.ClientSession` with a per-host connection limit.
+    Responses carrying an ETag or Last-Modified are kept on disk and
+    revalidated with a conditional request, immutable ones (like emojis,
+    whose URL changes with their content) are served straight from disk
+    """
+    user_agent = "Pesterchum-Discord"
+
+    def __init__(self, loop=None, cache_dir="cache/http", limit=32, limit_per_host=6, timeout=30, bandwidth=None,
+                 metrics=None):
+        self.loop = loop
+        self.cache_dir = cache_dir
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.bandwidth = bandwidth
+        self.metrics = metrics
+        self.session = None
+        self.timings = deque(maxlen=512)
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, loop=self.loop)
+            self.session = aiohttp.ClientSession(
+                connector=connector, loop=self.loop,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": self.user_agent})
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest())
+
+    def load_cached(self, url):
+        """Return the (metadata, body) cached for `url`, or None"""
+        path = self.cache_path(url)
+        try:
+            with open(path + ".json", 'r') as mf:
+                meta = json.load(mf)
+            with open(path, 'rb') as bf:
+                body = bf.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url:
+            return None
+        return meta, body
+
+    def run_blocking(self, func, *args):
+        """Run blocking file work in the loop's default executor, returns a future"""
+        return (self.loop or asyncio.get_event_loop()).run_in_executor(None, func, *args)
+
+    def store(self, url, headers, body, immutable):
+        """Write a cache entry, blocking: called in the executor"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.cache_path(url)
+        meta = dict(url=url, immutable=immutable,
+                    etag=headers.get("ETag"), last_modified=headers.get("Last-Modified"),
+                    content_type=headers.get("Content-Type"))
+        # Write then rename, so an interrupted write never leaves a torn entry.
+        # Temporary names are per thread, two stores of one URL may run at once
+        tmp = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp, 'wb') as bf:
+            bf.write(body)
+        os.replace(tmp, path)
+        with open(tmp, 'w') as mf:
+            json.dump(meta, mf)
+        os.replace(tmp, path + ".json")
+
+    def record(self, method, url, status, started, size, cached):
+        timing = Timing(method, urlsplit(url).netloc, status, time.monotonic() - started, size, cached)
+        self.timings.append(timing)
+        if self.bandwidth is not None and not cached:
+            self.bandwidth.add(size)
+        if self.metrics is not None:
+            self.metrics.observe("http.request", timing.elapsed)
+            self.metrics.inc("http.cached" if cached else "http.fetched")
+
+    async def get(self, url, immutable=False, cache=True, headers=None):
+        """
+        GET `url` and return a `Response`. With `cache`, validators are sent
+        for any cached copy and a 304 is answered from disk. `immutable`
+        responses are never revalidated once cached
+        """
+        started = time.monotonic()
+        headers = dict(headers or {})
+        cached = self.load_cached(url) if cache else None
+        if cached is not None:
+            meta, body = cached
+            if meta["immutable"]:
+                self.record("GET", url, 200, started, len(body), True)
+                return Response(200, meta, body, True)
+            if meta["etag"]:
+                headers["If-None-Match"] = meta["etag"]
+            if meta["last_modified"]:
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        async with self.get_session().get(url, headers=headers) as response:
+            if response.status == 304 and cached is not None:
+                self.record("GET", url, 304, started, 0, True)
+                return Response(200, cached[0], cached[1], True)
+            body = await response.read()
+            self.record("GET", url, response.status, started, len(body), False)
+            if cache and response.status == 200 and (
+                    immutable or "ETag" in response.headers or "Last-Modified" in response.headers):
+                await self.run_blocking(self.store, url, response.headers, body, immutable)
+            return Response(response.status, response.headers, body, False)
+
+    async def get_json(self, url, cache=True):
+        response = await self.get(url, cache=cache)
+        if response.status != 200:
+            raise aiohttp.ClientResponseError(None, (), status=response.status, message=url)
+        return json.loads(response.body.decode())
+
+    async def download(self, url, path, chunk_size=65536, progress=None, digest=None, resume=False):
+        """
+        Stream `url` to the file `path`, calling `progress(done, total)` as
+        chunks arrive and feeding them to the hashlib object `digest`. With
+        `resume`, an existing partial file is continued with a Range request
+        """
+        started = time.monotonic()
+        done = 0
+        headers = dict()
+        if resume and os.path.exists(path):
+            done = os.path.getsize(path)
+            if done:
+                headers["Range"] = "bytes={}-".format(done)
+        async with self.get_session().get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=None)) as response:
+            received = 0
+            if response.status == 416 and done:
+                # The partial file is already complete
+                if digest is not None:
+                    await self.run_blocking(hash_file, digest, path)
+            else:
+                response.raise_for_status()
+                if response.status != 206:
+                    done = 0  # Range ignored, start over
+                elif digest is not None:
+                    await self.run_blocking(hash_file, digest, path)
+                total = response.content_length
+                if total is not None:
+                    total += done
+                with open(path, 'ab' if done else 'wb') as f:
+                    async for data in response.content.iter_chunked(chunk_size):
+                        f.write(data)
+                        if digest is not None:
+                            digest.update(data)
+                        received += len(data)
+                        if progress is not None:
+                            progress(done + received, total)
+        self.record("GET", url, response.status, started, received, False)
+        return done + received